@@ -0,0 +1,243 @@
+import argparse
+import http.server
+import json
+import os
+import random
+import re
+import string
+import tempfile
+import threading
+import time
+import tracemalloc
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import pandas as pd
+
+import gene_lookup_v4 as lookup
+
+# Snapshot headers for each gd_ column code requested by makeAndFetchURL
+HEADERS = {
+    "hgnc_id": "HGNC ID",
+    "app_sym": "Approved symbol",
+    "app_name": "Approved name",
+    "prev_sym": "Previous symbols",
+    "aliases": "Alias symbols",
+    "pub_ensembl_id": "Ensembl gene ID",
+    "pub_eg_id": "NCBI Gene ID"}
+
+# Share of input rows drawn from each kind of label
+DEFAULT_MIX = {
+    "symbol": 0.55,
+    "alias": 0.12,
+    "previous": 0.08,
+    "hgnc": 0.06,
+    "ensembl": 0.06,
+    "ncbi": 0.06,
+    "list": 0.04,
+    "miss": 0.02,
+    "api": 0.01}
+
+MISS_POOL = 500 # Distinct labels that no backend knows
+API_POOL = 200 # Distinct labels only the fake REST service knows
+
+def _symbol(rng, used): # Helper function to make a unique symbol shaped like an HGNC one
+    while True:
+        symbol = "".join(rng.choices(string.ascii_uppercase, k=rng.randint(2, 5))) + str(rng.randint(1, 99))
+        if symbol not in used:
+            used.add(symbol)
+            return symbol
+
+def make_records(n_records, seed=0): # Synthetic HGNC records keyed by the snapshot headers
+    rng = random.Random(seed)
+    used = set()
+    records = []
+    for i in range(1, n_records + 1):
+        records.append({
+            "HGNC ID": str(i),
+            "Approved symbol": _symbol(rng, used),
+            "Approved name": f"synthetic gene {i}",
+            "Previous symbols": ", ".join(_symbol(rng, used) for _ in range(rng.choice([0, 0, 1, 2]))),
+            "Alias symbols": ", ".join(_symbol(rng, used) for _ in range(rng.choice([0, 1, 2, 3]))),
+            "Ensembl gene ID": f"ENSG{i:011d}",
+            "NCBI Gene ID": str(100000 + i) if rng.random() < 0.9 else ""})
+    # A few aliases shared between genes, as in the real table
+    for record in rng.sample(records, n_records // 100):
+        other = rng.choice(records)
+        if other["Alias symbols"]:
+            record["Alias symbols"] = ", ".join(filter(None, [record["Alias symbols"], other["Alias symbols"].split(", ")[0]]))
+    return records
+
+def make_api_records(n_records, seed=1): # REST-style records for genes missing from the snapshot
+    rng = random.Random(seed)
+    used = set()
+    return [{"hgnc_id": f"HGNC:{900000 + i}", "symbol": f"API{_symbol(rng, used)}", "name": f"remote gene {i}",
+             "prev_symbol": [], "alias_symbol": [f"APIALIAS{i}"], "alias_name": [],
+             "ensembl_gene_id": f"ENSG9{i:010d}", "entrez_id": str(9000000 + i)} for i in range(n_records)]
+
+def write_snapshot(records, path, columns=None): # Writes records as the tab separated text genenames.org returns
+    headers = [HEADERS[column] for column in (columns or HEADERS)]
+    pd.DataFrame(records, columns=headers).to_csv(path, sep="\t", index=False)
+    return path
+
+def make_gene_list(n_rows, records, api_records, mix=None, seed=2): # Synthetic input with a controlled mix of label kinds
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds = rng.choices(list(mix), weights=list(mix.values()), k=n_rows)
+    with_prev = [record for record in records if record["Previous symbols"]]
+    with_alias = [record for record in records if record["Alias symbols"]]
+    with_ncbi = [record for record in records if record["NCBI Gene ID"]]
+    misses = [f"MISSING{i}" for i in range(MISS_POOL)]
+
+    def label(kind):
+        if kind == "symbol":
+            return rng.choice(records)["Approved symbol"]
+        if kind == "alias":
+            return rng.choice(rng.choice(with_alias)["Alias symbols"].split(", "))
+        if kind == "previous":
+            return rng.choice(rng.choice(with_prev)["Previous symbols"].split(", "))
+        if kind == "hgnc":
+            return f"HGNC:{rng.choice(records)['HGNC ID']}"
+        if kind == "ensembl":
+            return rng.choice(records)["Ensembl gene ID"] + rng.choice(["", ".1", ".12"])
+        if kind == "ncbi":
+            return rng.choice(with_ncbi)["NCBI Gene ID"]
+        if kind == "list":
+            return ", ".join(label(rng.choice(["symbol", "alias", "previous", "miss"])) for _ in range(rng.randint(2, 4)))
+        if kind == "miss":
+            return rng.choice(misses)
+        return rng.choice(api_records[:API_POOL])["symbol"]
+
+    return pd.DataFrame({"Name": [label(kind) for kind in kinds], "Kind": kinds})
+
+class FakeHGNC: # Local stand-in for the genenames.org custom download and the HGNC REST fetch/search endpoints
+    def __init__(self, records, api_records):
+        self.records = records
+        self.fields = {}
+        for record in api_records:
+            for field, value in record.items():
+                for item in (value if isinstance(value, list) else [value]):
+                    self.fields.setdefault(field, {}).setdefault(item.casefold(), []).append(record)
+        self.requests = 0
+        fake = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                fake.requests += 1
+                url = urlsplit(self.path)
+                if url.path.endswith("/download"):
+                    columns = [column[3:] for column in parse_qs(url.query).get("col", [])]
+                    with tempfile.TemporaryDirectory() as directory:
+                        path = write_snapshot(fake.records, os.path.join(directory, "snapshot.txt"), columns)
+                        with open(path, "rb") as file:
+                            self._send(file.read(), "text/plain")
+                    return
+                path = unquote(url.path)
+                if path.startswith("/search/"):
+                    docs = {}
+                    for field, value in re.findall(r'(\w+):"((?:[^"\\]|\\.)*)"', path[len("/search/"):]):
+                        for record in fake.fields.get(field, {}).get(value.replace('\\"', '"').casefold(), []):
+                            docs[record["hgnc_id"]] = {"hgnc_id": record["hgnc_id"], "symbol": record["symbol"], "score": 1}
+                    docs = list(docs.values())
+                else:
+                    _, _, field, value = path.split("/", 3)
+                    if field == "hgnc_id" and not value.startswith("HGNC:"):
+                        value = f"HGNC:{value}"
+                    docs = fake.fields.get(field, {}).get(value.casefold(), [])[:1]
+                self._send(json.dumps({"response": {"numFound": len(docs), "docs": docs}}).encode(), "application/json")
+
+            def _send(self, body, content_type):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+def measure(function, *args, **kwargs): # Returns (result, seconds, peak MiB traced while function ran)
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function(*args, **kwargs)
+        return result, time.perf_counter() - start, tracemalloc.get_traced_memory()[1] / 2 ** 20
+    finally:
+        tracemalloc.stop()
+
+def run(sizes, snapshot_size=45000, api_rate=lookup.API_RATE_LIMIT, sample=2000, seed=0): # Runs every stage for each input size and returns one row per (size, stage)
+    records = make_records(snapshot_size, seed)
+    api_records = make_api_records(API_POOL, seed + 1)
+    results = []
+    original_urls = lookup.HGNC_DOWNLOAD_URL, lookup.HGNC_REST_URL
+    original_limiter = lookup._RATE_LIMITER
+    cwd = os.getcwd()
+
+    with FakeHGNC(records, api_records) as fake, tempfile.TemporaryDirectory() as directory:
+        lookup.HGNC_DOWNLOAD_URL = f"{fake.url}/cgi-bin/download"
+        lookup.HGNC_REST_URL = fake.url
+        lookup._RATE_LIMITER = lookup.TokenBucket(api_rate)
+        os.makedirs(os.path.join(directory, "Logs"))
+        os.makedirs(os.path.join(directory, "Outputs"))
+        os.chdir(directory)
+        try:
+            for size in sizes:
+                df = make_gene_list(size, records, api_records, seed=seed + 2)
+                cache_dir = os.path.join(directory, f"cache_{size}")
+                columns = lookup.addColumns(df, "Name")
+
+                def stage(name, function, *args, count=size, **kwargs):
+                    result, seconds, peak = measure(function, *args, **kwargs)
+                    results.append({"rows": size, "stage": name, "calls": count, "seconds": seconds,
+                                    "per_call_us": seconds / max(count, 1) * 1e6, "peak_mib": peak})
+                    return result
+
+                path = stage("download", lookup.makeAndFetchURL, columns, cache_dir=cache_dir, count=1)
+                stage("cached download", lookup.makeAndFetchURL, columns, cache_dir=cache_dir, count=1)
+                index = stage("index build", lookup.GeneIndex.from_file, path, count=1)
+                names = df["Name"].sample(min(size, sample), random_state=seed).tolist()
+                stage("search_single_gene", lambda: [lookup.search_single_gene(index, name) for name in names], count=len(names))
+                resolved = stage("offline resolve", lookup.resolve_gene_names, df["Name"], index, use_api=False)
+
+                misses = df["Name"][(resolved["matching_status"] == "un-matched").to_numpy()]
+                labels = [label.strip() for name in misses for label in name.split(",") if label.strip()]
+                distinct = list(dict.fromkeys(labels))
+                sample_labels = distinct[:min(len(distinct), 50)]
+                stage("find_API", lambda: [lookup.find_API(label) for label in sample_labels], count=len(sample_labels))
+                stage("find_API_batch", lookup.find_API_batch, distinct, count=len(distinct))
+                stats = stage("convert_gene_names", lookup.convert_gene_names, df, "Name", False, output_name=f"bench_{size}",
+                              offline=True, cache_dir=cache_dir, api_cache=False, return_stats=True)
+                for name, seconds in stats.timings.items(): # Break the end-to-end run down by its own stage timers
+                    results.append({"rows": size, "stage": f"  {name}", "calls": size, "seconds": seconds,
+                                    "per_call_us": seconds / size * 1e6, "peak_mib": float("nan")})
+        finally:
+            os.chdir(cwd)
+            lookup.HGNC_DOWNLOAD_URL, lookup.HGNC_REST_URL = original_urls
+            lookup._RATE_LIMITER = original_limiter
+    return pd.DataFrame(results)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark gene_lookup_v4 against a synthetic snapshot and a local fake HGNC service.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000], help="input rows per run (up to 10^6)")
+    parser.add_argument("--snapshot-size", type=int, default=45000, help="records in the synthetic HGNC snapshot")
+    parser.add_argument("--api-rate", type=float, default=lookup.API_RATE_LIMIT, help="requests per second allowed against the fake REST service")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="also write the results to this CSV")
+    args = parser.parse_args()
+
+    table = run(args.sizes, args.snapshot_size, args.api_rate, seed=args.seed)
+    print(table.to_string(index=False, float_format=lambda value: f"{value:.3f}"))
+    if args.output:
+        table.to_csv(args.output, index=False)
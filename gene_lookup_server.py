@@ -0,0 +1,197 @@
+import argparse
+import http.server
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import gene_lookup_v4 as lookup
+
+RELOAD_INTERVAL = 15 * 60 # Seconds between background checks for a newer snapshot
+MAX_BATCH = 100000 # Labels accepted in one batch request
+MAX_BODY = 64 * 2 ** 20 # Bytes accepted in one request body
+FIELDS = ['user_input'] + lookup.RESULT_COLUMNS + ['matching_status']
+NDJSON = "application/x-ndjson"
+
+class LookupService: # Keeps one snapshot index hot and swaps in a new one when the cached snapshot changes
+    def __init__(self, cache_dir=None, offline=False, use_api=True, mmap_index=False, reload_interval=RELOAD_INTERVAL):
+        self.cache_dir = cache_dir
+        self.offline = offline
+        self.use_api = use_api and not offline
+        self.mmap_index = mmap_index
+        self.reload_interval = reload_interval
+        self.api_cache = lookup.get_api_cache(cache_dir) if self.use_api else None
+        self.stats = lookup.RunStats()
+        self.index = None
+        self.source = None
+        self.loaded_at = None
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.reload()
+
+    def reload(self): # Revalidates the snapshot and, if the file changed, builds its index before swapping it in; returns True on swap
+        with self._reload_lock:
+            path = lookup.makeAndFetchURL(lookup.ALL_COLUMNS, cache_dir=self.cache_dir, offline=self.offline, stats=self.stats)
+            info = os.stat(path)
+            source = (path, info.st_size, info.st_mtime_ns)
+            if source == self.source:
+                return False
+            with self.stats.timer("index_build"):
+                index = lookup.load_mapped_index(path) if self.mmap_index else lookup.load_index(path, persist=True)
+            # Requests read self.index once, so they finish on the index they started with while new ones see the new snapshot
+            self.index, self.source, self.loaded_at = index, source, time.time()
+            logging.info(f"Serving snapshot {path} ({index.size} records)")
+            return True
+
+    def _reload_forever(self):
+        while not self._stop.wait(self.reload_interval):
+            try:
+                self.reload()
+            except Exception as e: # Keep serving the current index; the next interval tries again
+                logging.warning(f"Background snapshot reload failed: {e}")
+
+    def start(self): # Starts the background reload thread
+        threading.Thread(target=self._reload_forever, name="snapshot-reload", daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def resolve(self, names): # One result dict per name, with the columns convert_gene_names writes
+        index = self.index
+        memo = {}
+        labels = [label.strip() for name in names for label in name.split(',') if label.strip()]
+        lookup._stream_resolve(labels, index, memo, self.use_api, lookup.API_WORKERS, self.api_cache, self.stats)
+        self.stats.count("rows", len(names))
+        return [dict(zip(FIELDS, [name] + lookup._stream_row(name, memo))) for name in names]
+
+    def health(self):
+        return {"status": "ok", "snapshot": self.source[0], "records": self.index.size,
+                "loaded_at": self.loaded_at, "mmap_index": self.mmap_index, "api": self.use_api}
+
+def _parse_batch(body, content_type): # Helper function to read the labels of a batch request: a JSON list or {"labels": [...]}, NDJSON, or plain lines
+    text = body.decode('utf-8')
+    if content_type == NDJSON:
+        items = [json.loads(line) for line in text.splitlines() if line.strip()]
+        labels = [item.get("label", "") if isinstance(item, dict) else item for item in items]
+    elif content_type == "application/json":
+        data = json.loads(text)
+        labels = data.get("labels") if isinstance(data, dict) else data
+    else:
+        labels = text.splitlines()
+    if not isinstance(labels, list) or not all(isinstance(label, str) for label in labels):
+        raise ValueError("expected a list of label strings")
+    if len(labels) > MAX_BATCH:
+        raise ValueError(f"at most {MAX_BATCH} labels per request")
+    return labels
+
+def make_handler(service):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Keep-alive, so clients reuse one connection across lookups
+        disable_nagle_algorithm = True # Headers and body are separate writes; without this small responses wait on delayed ACKs
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == "/lookup" or url.path.startswith("/lookup/"):
+                labels = parse_qs(url.query).get("q") or [unquote(url.path[len("/lookup/"):])]
+                if not labels[0]:
+                    return self._send_json(400, {"error": "give a label as /lookup/<label> or /lookup?q=<label>"})
+                results = self._resolve(labels)
+                if results is not None:
+                    self._send_json(200, results[0] if len(results) == 1 else results)
+                return
+            if url.path == "/health":
+                return self._send_json(200, service.health())
+            if url.path == "/stats":
+                return self._send_json(200, service.stats.summary())
+            self._send_json(404, {"error": f"no such endpoint: {url.path}"})
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+            except ValueError:
+                length = -1
+            if length < 0: # Reading a body of unknown size would block, so the connection is dropped after answering
+                self.close_connection = True
+                return self._send_json(400, {"error": "Content-Length must be a non-negative integer"})
+            if length > MAX_BODY:
+                self.close_connection = True
+                return self._send_json(413, {"error": f"request body over {MAX_BODY} bytes"})
+            body = self.rfile.read(length)
+            if url.path == "/lookup":
+                content_type = (self.headers.get("Content-Type") or "").split(";")[0].strip()
+                try:
+                    labels = _parse_batch(body, content_type)
+                except ValueError as e: # json.JSONDecodeError and UnicodeDecodeError are ValueErrors too
+                    return self._send_json(400, {"error": str(e)})
+                results = self._resolve(labels)
+                if results is None:
+                    return
+                if content_type == NDJSON or NDJSON in (self.headers.get("Accept") or ""):
+                    return self._send(200, "".join(json.dumps(result) + "\n" for result in results).encode(), NDJSON)
+                return self._send_json(200, results)
+            if url.path == "/reload":
+                try:
+                    return self._send_json(200, {"reloaded": service.reload(), **service.health()})
+                except Exception as e:
+                    return self._send_json(503, {"error": f"reload failed: {e}"})
+            self._send_json(404, {"error": f"no such endpoint: {url.path}"})
+
+        def _resolve(self, labels): # service.resolve, answering 500 and returning None if it fails, so the client is never left without a response
+            try:
+                return service.resolve(labels)
+            except Exception as e:
+                logging.exception(f"Lookup of {len(labels)} labels failed")
+                self._send_json(500, {"error": f"lookup failed: {e}"})
+                return None
+
+        def _send_json(self, status, data):
+            self._send(status, json.dumps(data).encode(), "application/json")
+
+        def _send(self, status, body, content_type):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logging.debug(f"{self.address_string()} {format % args}")
+
+    return Handler
+
+def serve(service, host="127.0.0.1", port=8080): # Serves service until interrupted; one thread per connection
+    server = http.server.ThreadingHTTPServer((host, port), make_handler(service))
+    server.daemon_threads = True
+    service.start()
+    logging.info(f"Listening on http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve HGNC gene lookups from a snapshot index kept in memory.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--cache-dir", default=None, help="snapshot and API cache directory (default: $GENE_LOOKUP_CACHE or ./Cache)")
+    parser.add_argument("--offline", action="store_true", help="serve the cached snapshot only, never touching the network")
+    parser.add_argument("--no-api", action="store_true", help="keep the snapshot fresh but skip the REST fallback for misses")
+    parser.add_argument("--mmap", action="store_true", help="use the memory-mapped index")
+    parser.add_argument("--reload-interval", type=float, default=RELOAD_INTERVAL, help="seconds between checks for a newer snapshot")
+    args = parser.parse_args(argv)
+
+    lookup.setup_logging("server")
+    service = LookupService(args.cache_dir, offline=args.offline, use_api=not args.no_api, mmap_index=args.mmap,
+                            reload_interval=args.reload_interval)
+    print(f"Serving {service.index.size} records on http://{args.host}:{args.port}", flush=True)
+    serve(service, args.host, args.port)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,14 +1,35 @@
 import csv
+import email.utils
+import gzip
+import hashlib
+import json
+import mmap
+import multiprocessing
 import os
+import pickle
+import random
 import re
-import pandas as pd
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+import unicodedata
+import bisect
+from array import array
 import time
-import requests
 import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from collections import deque
+from itertools import islice
 from urllib.parse import quote
+# numpy, pandas and requests are imported inside the functions that use them, so the command line starts quickly
 
 def setup_logging(output_name):
     log_path = f"{os.getcwd()}/Logs/gene_lookup_{output_name}.log"
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
     # Remove all handlers associated with the root (old) logger
     for handler in logging.root.handlers[:]:
         logging.root.removeHandler(handler)
@@ -17,7 +38,130 @@ def setup_logging(output_name):
         filemode='a',
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s')
-    logging.info(f"Began new lookup using gene_lookup_v3.")
+    logging.info(f"Began new lookup using gene_lookup_v4.")
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5] # Upper bounds in seconds of the API latency histogram
+PROGRESS_INTERVAL = 2.0 # Seconds between progress reports
+PROGRESS_WINDOW = 5 # Reports the ETA's rates are measured over
+
+class RunStats: # Per-stage wall-clock timings and counters for one run, safe to update from API worker threads
+    # progress, if given, is called with a progress() dict every progress_interval seconds inside reporting(), from its own
+    # thread, so the matching code pays nothing for it and a stalled API fallback still gets reported
+    def __init__(self, progress=None, progress_interval=PROGRESS_INTERVAL):
+        self.timings = {}
+        self.counters = {}
+        self.api_latency = [0] * (len(LATENCY_BUCKETS) + 1)
+        self._lock = threading.Lock()
+        self.progress_callback = progress
+        self.progress_interval = progress_interval
+        self.total_rows = None # Rows the run expects to process, when known, for the ETA
+        self.stage = None
+        self._started = time.perf_counter()
+        self._last_report = (self._started, 0)
+        self._recent = deque([(self._started, 0, 0)], maxlen=PROGRESS_WINDOW) # (time, resolved rows, API requests done) of the latest reports
+
+    @contextmanager
+    def timer(self, stage): # Adds the time spent in the with-block to stage
+        start = time.perf_counter()
+        outer, self.stage = self.stage, stage
+        try:
+            yield
+        finally:
+            self.stage = outer
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def record_latency(self, seconds):
+        with self._lock:
+            self.api_latency[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def progress(self, done=False): # Rows so far, offline and API resolutions, API requests waiting, current rows/s and ETA in seconds
+        now = time.perf_counter()
+        with self._lock:
+            counters = dict(self.counters)
+            last_time, last_rows = self._last_report
+            rows = counters.get("rows", 0) + counters.get("resumed_rows", 0)
+            self._last_report = (now, rows)
+            first_time, first_rows, first_api = self._recent[0]
+            self._recent.append((now, counters.get("rows", 0), counters.get("api_done", 0)))
+        # Rates over the last few reports, since an offline burst followed by a slow API fallback makes the run average useless.
+        # Rows resumed from a journal took no time, so they are left out. Rows waiting on the API cannot finish before the
+        # requests queued ahead of them, so the ETA is at least the time the queue takes to drain at the current request rate.
+        elapsed = now - first_time
+        remaining = self.total_rows - rows if self.total_rows else None
+        pending = counters.get("api_queued", 0) - counters.get("api_done", 0)
+        row_rate = (counters.get("rows", 0) - first_rows) / elapsed if elapsed > 0 else 0.0
+        api_rate = (counters.get("api_done", 0) - first_api) / elapsed if elapsed > 0 else 0.0
+        eta = remaining / row_rate if remaining is not None and row_rate else None
+        if eta is not None and pending:
+            eta = max(eta, pending / api_rate) if api_rate else None
+        return {"rows": rows, "total_rows": self.total_rows, "offline_hits": counters.get("offline_hits", 0),
+                "api_hits": counters.get("api_hits", 0), "api_calls": counters.get("api_calls", 0), "api_pending": pending,
+                "rows_per_sec": (rows - last_rows) / (now - last_time) if now > last_time else 0.0,
+                "eta": eta, "elapsed": now - self._started, "stage": self.stage, "done": done}
+
+    @contextmanager
+    def reporting(self): # Reports progress at the interval while the with-block runs, and once more when it ends
+        if self.progress_callback is None:
+            yield
+            return
+        stop = threading.Event()
+
+        def report():
+            while not stop.wait(self.progress_interval):
+                self.progress_callback(self.progress())
+
+        thread = threading.Thread(target=report, name="progress", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            self.progress_callback(self.progress(done=True))
+
+    def summary(self):
+        labels = [f"<={bound}s" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+        return {"timings": {stage: round(seconds, 4) for stage, seconds in self.timings.items()},
+                "counters": dict(self.counters),
+                "api_latency": dict(zip(labels, self.api_latency))}
+
+    def log_summary(self): # Writes the whole summary as one structured log line
+        logging.info(f"Run summary: {json.dumps(self.summary(), sort_keys=True)}")
+
+    def __repr__(self):
+        return f"RunStats({self.summary()})"
+
+def _format_seconds(seconds): # Helper function to show a duration as H:MM:SS or M:SS
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+class ConsoleProgress: # Progress callback printing a one-line status, redrawn in place on a terminal and one line per report otherwise
+    def __init__(self, file=None):
+        self.file = file or sys.stderr
+        self._width = 0
+
+    def __call__(self, progress):
+        total = progress["total_rows"]
+        parts = [f"{progress['rows']:,}/{total:,} rows ({progress['rows'] / total:.0%})" if total else f"{progress['rows']:,} rows",
+                 f"{progress['rows_per_sec']:,.0f} rows/s", f"offline hits {progress['offline_hits']:,}", f"API hits {progress['api_hits']:,}",
+                 f"API queue {progress['api_pending']:,}"]
+        if progress["eta"] is not None and not progress["done"]:
+            parts.append(f"ETA {_format_seconds(progress['eta'])}")
+        parts.append(f"done in {_format_seconds(progress['elapsed'])}" if progress["done"] else progress["stage"] or "")
+        line = " | ".join(part for part in parts if part)
+        if self.file.isatty():
+            self.file.write("\r" + line.ljust(self._width) + ("\n" if progress["done"] else ""))
+            self._width = len(line)
+        else:
+            self.file.write(line + "\n")
+        self.file.flush()
 
 #Figure out which columns need to be included in the API
 def addColumns(df, names_col):
@@ -50,17 +194,140 @@ def createDownloadURL(columns):
     url_parts = [f"col=gd_{entry}" for entry in columns]
     return "&".join(url_parts) + "&" if url_parts else ""
     
-def makeAndFetchURL(columns):
-    BASE_URL = "https://www.genenames.org/cgi-bin/download/custom?"
+HTTP_TIMEOUT = (5, 30) # Connect and read timeouts in seconds
+HTTP_RETRIES = 4
+HTTP_BACKOFF = 0.5 # Base delay in seconds, doubled after each failed attempt
+HTTP_MAX_DELAY = 60
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_SESSION = None
+_SESSION_LOCK = threading.Lock()
+
+def get_session(): # Shared requests.Session so connections are pooled and kept alive across calls and threads
+    import requests
+    import requests.adapters
+    global _SESSION
+    with _SESSION_LOCK:
+        if _SESSION is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _SESSION = session
+    return _SESSION
+
+def _retry_after(response): # Helper function to read a Retry-After header (seconds or an HTTP date) as a delay in seconds
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def http_get(url, headers=None, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, rate_limiter=None, stats=None, **kwargs): # GET through the shared session, with retries
+    import requests
+    for attempt in range(retries + 1):
+        if rate_limiter:
+            rate_limiter.acquire()
+        try:
+            response = get_session().get(url, headers=headers, timeout=timeout, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == retries:
+                raise
+            delay, reason = None, e
+        else:
+            if response.status_code not in RETRY_STATUSES or attempt == retries:
+                return response
+            delay, reason = _retry_after(response), f"status code {response.status_code}"
+            response.close()
+
+        if delay is None: # Exponential backoff with jitter so parallel workers do not retry in lockstep
+            delay = HTTP_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5)
+        delay = min(delay, HTTP_MAX_DELAY)
+        logging.info(f"Retrying {url} in {delay:.1f}s after {reason}")
+        if stats:
+            stats.count("retries")
+        time.sleep(delay)
+
+HGNC_DOWNLOAD_URL = "https://www.genenames.org/cgi-bin/download/custom"
+SNAPSHOT_TTL = 24 * 60 * 60 # Seconds before a cached snapshot is revalidated against genenames.org
+
+def _cache_dir(cache_dir=None): # Helper function to get (and create) the snapshot cache directory
+    cache_dir = cache_dir or os.environ.get("GENE_LOOKUP_CACHE") or os.path.join(os.getcwd(), "Cache")
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def _snapshot_paths(columns, cache_dir): # Helper function to key a cached snapshot by its (order independent) column set
+    key = hashlib.sha1(",".join(sorted(set(columns))).encode()).hexdigest()[:16]
+    base = os.path.join(cache_dir, f"hgnc_{key}")
+    return f"{base}.tsv", f"{base}.json"
+
+def _read_meta(meta_path): # Helper function to read cache metadata, treating a missing or corrupt file as empty
+    try:
+        with open(meta_path, encoding='utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def _atomic_write(path, chunks): # Helper function to write to a temp file in the same directory then rename over path
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp_")
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            for chunk in chunks:
+                file.write(chunk)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+def _write_meta(meta_path, meta):
+    _atomic_write(meta_path, [json.dumps(meta, indent=1).encode()])
+
+def makeAndFetchURL(columns, cache_dir=None, ttl=SNAPSHOT_TTL, offline=False, base_url=None, stats=None):
     REST = "status=Approved&hgnc_dbtag=off&order_by=gd_app_sym_sort&format=text&submit=submit" #Status, HGNC DB Tag, sorting, formatting, submit
     COLS = createDownloadURL(columns)
-    FULL_URL = f"{BASE_URL}{COLS}{REST}"
-    
-    df = pd.read_csv(FULL_URL, delimiter="\t")
-    temp_path = 'tempData.csv'
-    df.to_csv('tempData.csv', index=False)
+    FULL_URL = f"{base_url or HGNC_DOWNLOAD_URL}?{COLS}{REST}"
+
+    data_path, meta_path = _snapshot_paths(columns, _cache_dir(cache_dir))
+    meta = _read_meta(meta_path) if os.path.exists(data_path) else {}
+    if meta and (offline or time.time() - meta.get("fetched_at", 0) < ttl):
+        if stats:
+            stats.count("snapshot_cache_hits")
+        return data_path
+    if offline:
+        raise FileNotFoundError(f"No cached HGNC snapshot for columns {columns}; run once without offline=True")
+
+    import requests
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    try:
+        response = http_get(FULL_URL, headers=headers, stream=True, timeout=(10, 300), stats=stats)
+        if response.status_code not in (200, 304):
+            raise requests.HTTPError(f"HGNC download returned status code {response.status_code}", response=response)
+        if response.status_code == 200:
+            _atomic_write(data_path, response.iter_content(chunk_size=1 << 16))
+    except (requests.RequestException, OSError) as e:
+        if not meta:
+            raise
+        logging.warning(f"Could not refresh HGNC snapshot ({e}), using cached copy from {time.ctime(meta.get('fetched_at', 0))}")
+        return data_path
 
-    return temp_path
+    meta.update({"url": FULL_URL, "columns": list(columns), "fetched_at": time.time()})
+    if response.status_code == 200:
+        meta["etag"] = response.headers.get("ETag")
+        meta["last_modified"] = response.headers.get("Last-Modified")
+    _write_meta(meta_path, meta)
+    if stats:
+        stats.count("snapshot_downloads" if response.status_code == 200 else "snapshot_revalidations")
+    return data_path
         
 def transform_string(input_string):
     if input_string.startswith("ENSG"): # Ensembl gene ID: starts with 'ENSG'
@@ -71,37 +338,1020 @@ def transform_string(input_string):
         return input_string, "NCBI Gene ID"
     return input_string, None # Default: return as-is, with None type
 
-def _contains_gene(value, gene_name): # Helper function to return True if gene_name is in value (comma-separated or exact)
+# Greek letters spelled the way HGNC writes them in symbols (IL-1β is IL1B, PKCθ is PRKCQ)
+GREEK_LETTERS = str.maketrans({greek: latin for letters, latin in [("αΑ", "A"), ("βΒ", "B"), ("γΓ", "G"), ("δΔ", "D"), ("εΕ", "E"), ("ζΖ", "Z"),
+                                                                   ("ηΗ", "H"), ("θΘ", "Q"), ("ιΙ", "I"), ("κΚ", "K"), ("λΛ", "L"), ("μΜ", "M")]
+                               for greek in letters})
+# Prefixes other tools put in front of IDs, and the ID type each one marks
+ID_PREFIXES = {"HGNC": "HGNC ID", "NCBIGENE": "NCBI Gene ID", "NCBI": "NCBI Gene ID", "ENTREZ": "NCBI Gene ID", "GENEID": "NCBI Gene ID",
+               "ENSEMBL": "Ensembl gene ID"}
+
+def normalize_key(value): # Folds a symbol to its normalized key, returning (key, names of the rules that changed it)
+    rules = []
+    key = value
+    if not key.isascii(): # Most keys are plain ASCII symbols and skip the Unicode steps
+        key = unicodedata.normalize('NFKC', value)
+        if key != value:
+            rules.append("unicode")
+        greek = key.translate(GREEK_LETTERS)
+        if greek != key:
+            rules.append("greek")
+            key = greek
+    joined = "".join(key.split())
+    if joined != key:
+        rules.append("whitespace")
+        key = joined
+    folded = key.upper() if key.isascii() else key.casefold().upper()
+    if folded != key:
+        rules.append("case")
+        key = folded
+    return key, rules
+
+def normalize_label(label): # Like transform_string, but after normalize_key and with prefixed, versioned and spreadsheet-mangled IDs recognized
+    key, rules = normalize_key(label)
+    gene_type = None
+    prefix = re.match(r'(HGNC|NCBIGENE|NCBI|ENTREZ|GENEID|ENSEMBL)[:_-]?(?=\d|ENSG)', key)
+    if prefix:
+        key, gene_type = key[prefix.end():], ID_PREFIXES[prefix.group(1)]
+        rules.append("prefix")
+    if key.startswith("ENSG") and gene_type in (None, "Ensembl gene ID"):
+        if '.' in key:
+            key = key.split('.', 1)[0]
+            rules.append("ensembl_version")
+        return key, "Ensembl gene ID", rules
+    decimal = re.fullmatch(r'(\d+)\.0+', key) # 1234.0 after a spreadsheet round trip
+    if decimal:
+        key = decimal.group(1)
+        rules.append("decimal")
+    if key.isdigit():
+        return key, gene_type or "NCBI Gene ID", rules
+    return key, gene_type, rules
+
+RESULT_COLUMNS = ['Approved symbol', 'Approved name', 'Previous symbols', 'Alias symbols']
+# Order in which snapshot columns are tried for labels that are not an ID
+MATCH_PRIORITY = ['Approved symbol', 'Previous symbols', 'Alias symbols', 'HGNC ID', 'Ensembl gene ID', 'NCBI Gene ID', 'Approved name']
+
+def classify_labels(labels): # Vectorized transform_string: returns the lookup keys and ID types of a Series of labels
+    import pandas as pd
+    labels = labels.astype(str)
+    if labels.empty: # str.partition of an empty Series has no columns to pick from
+        return labels, pd.Series(None, index=labels.index, dtype=object)
+    is_ensembl = labels.str.startswith("ENSG")
+    is_hgnc = labels.str.startswith("HGNC:")
+    is_ncbi = labels.str.isdigit()
+    keys = labels.mask(is_ensembl, labels.str.split('.', n=1).str[0]).mask(is_hgnc, labels.str.partition(':')[2])
+    types = pd.Series(None, index=labels.index, dtype=object)
+    types = types.mask(is_ncbi, "NCBI Gene ID").mask(is_hgnc, "HGNC ID").mask(is_ensembl, "Ensembl gene ID")
+    return keys, types
+
+def _split_cell(value): # Helper function to get every key a cell can be matched by (exact value and comma-separated items)
     if not value:
-        return False
-    if gene_name == value:
-        return True
-    return gene_name in {item.strip() for item in value.split(',')}
+        return set()
+    keys = {item.strip() for item in value.split(',')}
+    keys.add(value)
+    keys.discard('')
+    return keys
 
-def _extract_columns(result_df): # Helper function to extract columns or empty Series if result_df is empty
-    cols = ['Approved symbol', 'Approved name', 'Previous symbols', 'Alias symbols']
-    return tuple(result_df.get(col, pd.Series(dtype=str)) for col in cols)
+# Integer coding for ID columns: (prefix, digits) so "ENSG00000141510" is stored as 141510 and decoded back
+ID_CODECS = {'HGNC ID': ('', 0), 'NCBI Gene ID': ('', 0), 'Ensembl gene ID': ('ENSG', 11)}
 
-def search_single_gene(database_path, gene_name):
-    gene_name, gene_type = transform_string(gene_name)
+def _id_code(column, value): # Helper function to get the integer code of an ID, or None if value does not round-trip through one
+    prefix, width = ID_CODECS[column]
+    digits = value[len(prefix):]
+    if not (value.startswith(prefix) and digits.isascii() and digits.isdigit()):
+        return None
+    code = int(digits)
+    return code if code and f"{code:0{width}d}" == digits else None
+
+def _decode_id(column, code): # Helper function to turn an ID code back into the snapshot's text
+    prefix, digits = ID_CODECS[column]
+    return f"{prefix}{int(code):0{digits}d}"
+
+def _encode_ids(column, values): # Helper function to pack an ID column into an int64 array (0 = empty), or None if any value does not fit
+    codes = array('q')
+    for value in values:
+        code = _id_code(column, value) if value else 0
+        if code is None:
+            return None
+        codes.append(code)
+    return codes
+
+def _add_row(keys, key, row_id): # Helper function to add a row id to a key's row ids (an int, or a tuple, put in snapshot order by patch)
+    existing = keys.get(key)
+    if existing is None:
+        keys[key] = row_id
+    else:
+        keys[key] = tuple(sorted(set((existing,) if isinstance(existing, int) else existing) | {row_id}))
+
+def _drop_row(keys, key, row_id): # Helper function to remove a row id from a key's row ids, deleting the key once none are left
+    existing = keys.get(key)
+    remaining = tuple(other for other in ((existing,) if isinstance(existing, int) else existing or ()) if other != row_id)
+    if not remaining:
+        keys.pop(key, None)
+    else:
+        keys[key] = remaining[0] if len(remaining) == 1 else remaining
+
+INDEX_FORMAT = 6 # Bump whenever GeneIndex's layout changes so saved index files are rebuilt
+
+def _snapshot_signature(path): # Helper function to identify the exact snapshot file an index was built from
+    info = os.stat(path)
+    return (INDEX_FORMAT, info.st_size, info.st_mtime_ns)
+
+class GeneIndex: # Compact hash index over a downloaded snapshot, built once so each lookup is O(1)
+    # Text columns are lists of interned strings (None when empty); each key maps to a row id, or a tuple of
+    # row ids when several rows share it. ID columns are int64 arrays searched through a sorted copy instead, unless
+    # some value cannot be coded, in which case they stay text. ambiguous maps every text key that leads to more than
+    # one gene to all its (row id, column) candidates; ambiguous_ids holds, per ID column, the IDs that several rows
+    # share. normalized maps, per text column, the normalize_key form of each key that differs from the key itself,
+    # for lookup_normalized. rank holds each row's position in the snapshot, which breaks every tie between rows; it
+    # is the row id itself until patch adds genes.
+    def __init__(self, fieldnames, rows):
+        import numpy as np
+        self.fieldnames = list(fieldnames)
+        self.priority = sorted(self.fieldnames, key=lambda column: MATCH_PRIORITY.index(column) if column in MATCH_PRIORITY else len(MATCH_PRIORITY))
+        self.keys = {column: {} for column in self.fieldnames}
+        self.columns = {}
+        self.size = 0
+        self._frames = None
+        self._index_file = None # (path, signature) once saved or loaded, where get_fuzzy_index keeps the FuzzyIndex arrays
+
+        raw = {column: [] for column in self.fieldnames}
+        for row_id, row in enumerate(rows):
+            for column in self.fieldnames:
+                value = row.get(column) or None
+                raw[column].append(sys.intern(value) if value else None)
+                keys = self.keys[column]
+                for key in _split_cell(value):
+                    key = sys.intern(key)
+                    existing = keys.get(key)
+                    if existing is None:
+                        keys[key] = row_id
+                    else:
+                        keys[key] = (existing, row_id) if isinstance(existing, int) else existing + (row_id,)
+            self.size = row_id + 1
+        self.rank = array('q', range(self.size))
+
+        self.sorted_ids = {}
+        self.ambiguous_ids = {}
+        for column, values in raw.items():
+            codes = _encode_ids(column, values) if column in ID_CODECS else None
+            self.columns[column] = codes if codes is not None else values
+            if codes is not None:
+                codes = np.frombuffer(codes, dtype=np.int64)
+                order = np.argsort(codes, kind='stable')
+                self.sorted_ids[column] = (codes[order], order)
+                del self.keys[column]
+                shared, counts = np.unique(codes[codes != 0], return_counts=True)
+                self.ambiguous_ids[column] = {_decode_id(column, code) for code in shared[counts > 1]}
+            elif column in ID_CODECS: # IDs that could not be coded stay text keys, shared when they hold several rows
+                self.ambiguous_ids[column] = {key for key, row_ids in self.keys[column].items() if not isinstance(row_ids, int)}
+        self.ambiguous = self._find_ambiguous()
+        self.normalized = {}
+        for column, keys in self.keys.items():
+            normalized = self.normalized[column] = {}
+            for key, row_ids in keys.items():
+                if ',' in key: # Whole multi-value cells; input labels are split on commas, so these never match normalized
+                    continue
+                folded = normalize_key(key)[0]
+                if folded != key:
+                    existing = normalized.get(folded)
+                    normalized[folded] = row_ids if existing is None else tuple(dict.fromkeys(
+                        ((existing,) if isinstance(existing, int) else existing) + ((row_ids,) if isinstance(row_ids, int) else row_ids)))
+
+    def _find_ambiguous(self): # Keys shared by several genes, within a column or across columns, with candidates in lookup order
+        columns = [column for column in self.priority if column in self.keys]
+        seen, shared = set(), set()
+        for column in columns:
+            keys = self.keys[column]
+            shared.update(key for key, row_ids in keys.items() if not isinstance(row_ids, int))
+            shared.update(seen.intersection(keys))
+            seen.update(keys)
+        ambiguous = {}
+        for key in shared:
+            first = self._first_columns(key, columns)
+            if len(first) > 1:
+                ambiguous[key] = tuple(first.items())
+        return ambiguous
+
+    def _first_columns(self, key, columns): # {row id: column} for every gene holding key, each with its highest-priority match type
+        first = {}
+        for column in columns:
+            for row_id in self.row_ids(column, key):
+                first.setdefault(row_id, column)
+        return first
+
+    @classmethod
+    def from_file(cls, database_path):
+        delimiter = ',' if database_path.endswith('.csv') else '\t'
+        with open(database_path, mode='r', encoding='utf-8', newline='') as file:
+            reader = csv.DictReader(file, delimiter=delimiter)
+            return cls(reader.fieldnames, reader)
+
+    def save(self, path, source): # Writes the index as a NumPy archive tied to the source snapshot; the join tables are rebuilt on demand
+        # Arrays are stored as they are and everything else as one JSON document, so loading never unpickles anything
+        import io
+        import numpy as np
+        text = {column: values for column, values in self.columns.items() if column not in self.sorted_ids}
+        meta = {'fieldnames': self.fieldnames, 'size': self.size, 'ids': list(self.sorted_ids), 'text': text, 'keys': self.keys, 'normalized': self.normalized,
+                'ambiguous': self.ambiguous, 'ambiguous_ids': {column: sorted(ids) for column, ids in self.ambiguous_ids.items()}}
+        arrays = {'signature': np.array(_snapshot_signature(source), dtype=np.int64), 'rank': np.frombuffer(self.rank, dtype=np.int64),
+                  'meta': np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8)}
+        for number, (column, (codes, order)) in enumerate(self.sorted_ids.items()):
+            arrays[f"codes_{number}"], arrays[f"sorted_{number}"], arrays[f"order_{number}"] = np.frombuffer(self.columns[column], dtype=np.int64), codes, order
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        _atomic_write(path, [buffer.getvalue()])
+        self._index_file = (path, _snapshot_signature(source))
+
+    @classmethod
+    def load(cls, path, source): # Reads an index saved for source, or returns None if it is missing, unreadable, stale or from another version
+        import numpy as np
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if tuple(data['signature'].tolist()) != _snapshot_signature(source): # Checked before the rest is read
+                    return None
+                meta = json.loads(data['meta'].tobytes())
+                index = cls.__new__(cls)
+                index.fieldnames = meta['fieldnames']
+                index.priority = sorted(index.fieldnames, key=lambda column: MATCH_PRIORITY.index(column) if column in MATCH_PRIORITY else len(MATCH_PRIORITY))
+                index.size = meta['size']
+                index.rank = array('q', data['rank'].tobytes())
+                index.columns, index.sorted_ids = {}, {}
+                for number, column in enumerate(meta['ids']):
+                    index.columns[column] = array('q', data[f"codes_{number}"].tobytes())
+                    index.sorted_ids[column] = (data[f"sorted_{number}"], data[f"order_{number}"])
+            for column in index.fieldnames:
+                if column in meta['text']:
+                    index.columns[column] = [sys.intern(value) if value else None for value in meta['text'][column]]
+            index.keys = {column: {sys.intern(key): row_ids if isinstance(row_ids, int) else tuple(row_ids) for key, row_ids in keys.items()}
+                          for column, keys in meta['keys'].items()}
+            index.normalized = {column: {key: row_ids if isinstance(row_ids, int) else tuple(row_ids) for key, row_ids in keys.items()}
+                                for column, keys in meta['normalized'].items()}
+            index.ambiguous = {key: tuple(map(tuple, candidates)) for key, candidates in meta['ambiguous'].items()}
+            index.ambiguous_ids = {column: set(ids) for column, ids in meta['ambiguous_ids'].items()}
+            index._frames = None
+            index._index_file = (path, _snapshot_signature(source))
+        except Exception as e: # A file written by another version, or damaged, is rebuilt like a stale one
+            if not isinstance(e, FileNotFoundError):
+                logging.info(f"Ignoring index file {path}: {e!r}")
+            return None
+        return index
 
-    with open(database_path, mode='r', encoding='utf-8') as file:
-        reader = csv.DictReader(file)
-        columns = reader.fieldnames
+    def diff(self, database_path): # Compares a newer snapshot with the indexed one by HGNC ID, returning (changes, updates, order) for patch
+        # changes are CHANGE_COLUMNS dicts; updates are (row id, row) pairs, with row id None for an added gene and row None
+        # for one that left the snapshot; order lists the newer snapshot's HGNC IDs in file order. Raises ValueError when the
+        # snapshot cannot be patched in (other columns, no HGNC IDs, or an ID the integer coding cannot hold), so the caller
+        # rebuilds instead; the index is not touched either way.
+        with open(database_path, mode='r', encoding='utf-8', newline='') as file:
+            reader = csv.reader(file, delimiter=',' if database_path.endswith('.csv') else '\t')
+            fieldnames = next(reader, None)
+            if fieldnames != self.fieldnames or 'HGNC ID' not in self.fieldnames:
+                raise ValueError(f"{database_path} has columns {fieldnames}, the index has {self.fieldnames}")
+            # Whole rows are compared as tuples, with the ID columns decoded in one pass, rather than cell by cell
+            old_rows = list(zip(*[[_decode_id(column, code) if code else None for code in values] if column in self.sorted_ids else values
+                                  for column, values in ((column, self.columns[column]) for column in self.fieldnames)]))
+            hgnc, symbol = self.fieldnames.index('HGNC ID'), self.fieldnames.index('Approved symbol')
+            rows = {old[hgnc]: row_id for row_id, old in enumerate(old_rows) if old[hgnc]}
+            id_columns = [(position, column) for position, column in enumerate(self.fieldnames) if column in self.sorted_ids]
+            changes, updates, order = [], [], []
+            for values in reader:
+                new = tuple(value or None for value in values)
+                order.append(new[hgnc])
+                row_id = rows.pop(new[hgnc], None)
+                if row_id is not None and old_rows[row_id] == new:
+                    continue
+                for position, column in id_columns:
+                    if new[position] and _id_code(column, new[position]) is None:
+                        raise ValueError(f"{column} {new[position]!r} of {new[hgnc]} does not fit the index's integer coding")
+                row = dict(zip(self.fieldnames, values))
+                if row_id is None:
+                    changes.append({'hgnc_id': new[hgnc], 'symbol': new[symbol], 'change': 'added', 'column': '',
+                                    'old_value': '', 'new_value': new[symbol]})
+                    updates.append((None, row))
+                    continue
+                old = old_rows[row_id]
+                for position, column in enumerate(self.fieldnames):
+                    if old[position] != new[position]:
+                        changes.append({'hgnc_id': new[hgnc], 'symbol': old[symbol], 'change': 'renamed' if column == 'Approved symbol' else 'updated',
+                                        'column': column, 'old_value': old[position] or '', 'new_value': values[position]})
+                updates.append((row_id, row))
+            for hgnc_id, row_id in rows.items():
+                changes.append({'hgnc_id': hgnc_id, 'symbol': old_rows[row_id][symbol], 'change': 'withdrawn', 'column': '',
+                                'old_value': old_rows[row_id][symbol] or '', 'new_value': ''})
+                updates.append((row_id, None))
+        return changes, updates, order
 
-        for row in reader:
-            if gene_type:
-                if _contains_gene(row.get(gene_type), gene_name):
-                    result_df = pd.DataFrame([row])
-                    return (*_extract_columns(result_df), [gene_type])
+    def patch(self, updates, order): # Applies diff's updates in place, re-indexing only the keys of the rows that changed
+        # A gene that leaves the snapshot keeps its row id as an empty row, so the ids of every other row stay valid. An
+        # added gene takes the next row id, so rows shared by a key are re-ordered by their rank in the newer snapshot
+        # (order), and the key picks the same gene a fresh build of that snapshot would.
+        import numpy as np
+        touched = set()
+        for row_id, row in updates:
+            if row_id is None:
+                row_id = self.size
+                self.size += 1
+                for column in self.fieldnames:
+                    self.columns[column].append(None if column not in self.sorted_ids else 0)
+            for column in self.fieldnames:
+                old, new = self.value(column, row_id), (row or {}).get(column) or None
+                if old == new:
+                    continue
+                if column in self.sorted_ids:
+                    self.columns[column][row_id] = _id_code(column, new) if new else 0
+                    continue
+                self.columns[column][row_id] = sys.intern(new) if new else None
+                keys, normalized = self.keys[column], self.normalized[column]
+                for key in _split_cell(old):
+                    touched.add(key)
+                    _drop_row(keys, key, row_id)
+                    if ',' not in key and normalize_key(key)[0] != key:
+                        _drop_row(normalized, normalize_key(key)[0], row_id)
+                for key in _split_cell(new):
+                    key = sys.intern(key)
+                    touched.add(key)
+                    _add_row(keys, key, row_id)
+                    if ',' not in key and normalize_key(key)[0] != key:
+                        _add_row(normalized, normalize_key(key)[0], row_id)
+
+        positions = {hgnc_id: position for position, hgnc_id in enumerate(order)}
+        self.rank = array('q', (positions.get(self.value('HGNC ID', row_id), len(order)) for row_id in range(self.size)))
+        for keys in [*self.keys.values(), *self.normalized.values()]:
+            for key, row_ids in keys.items():
+                if not isinstance(row_ids, int):
+                    ranked = tuple(sorted(row_ids, key=self.rank.__getitem__))
+                    if ranked != row_ids:
+                        keys[key] = ranked
+                        touched.add(key)
+        rank = np.frombuffer(self.rank, dtype=np.int64)
+        for column in self.sorted_ids:
+            codes = np.frombuffer(self.columns[column], dtype=np.int64)
+            by_code = np.lexsort((rank, codes))
+            self.sorted_ids[column] = (codes[by_code], by_code)
+            shared, counts = np.unique(codes[codes != 0], return_counts=True)
+            self.ambiguous_ids[column] = {_decode_id(column, code) for code in shared[counts > 1]}
+        for column in self.ambiguous_ids.keys() - self.sorted_ids.keys():
+            self.ambiguous_ids[column] = {key for key, row_ids in self.keys[column].items() if not isinstance(row_ids, int)}
+        columns = [column for column in self.priority if column in self.keys]
+        for key in touched:
+            first = self._first_columns(key, columns)
+            if len(first) > 1:
+                self.ambiguous[key] = tuple(first.items())
+            else:
+                self.ambiguous.pop(key, None)
+        self._frames = None
+        self._index_file = None # The saved file no longer matches until the caller saves again
+        _FUZZY_CACHE.pop(id(self), None)
+
+    def value(self, column, row_id): # Cell text for one row, decoding integer-coded IDs
+        values = self.columns.get(column)
+        if values is None:
+            return None
+        value = values[row_id]
+        if isinstance(values, array):
+            return _decode_id(column, value) if value else None
+        return value
+
+    def record(self, row_id): # The result columns of one row as a tuple
+        return tuple(self.value(column, row_id) for column in RESULT_COLUMNS)
+
+    def row_ids(self, column, key): # All rows holding key in column, in snapshot (rank) order
+        import numpy as np
+        if column in self.sorted_ids:
+            code = _id_code(column, key)
+            if not code:
+                return ()
+            codes, order = self.sorted_ids[column]
+            start, stop = np.searchsorted(codes, code, side='left'), np.searchsorted(codes, code, side='right')
+            return tuple(int(row_id) for row_id in order[start:stop])
+        row_ids = self.keys.get(column, {}).get(key)
+        if row_ids is None:
+            return ()
+        return (row_ids,) if isinstance(row_ids, int) else row_ids
+
+    def lookup(self, gene_name, gene_type=None): # Returns (record, matched column), trying columns in MATCH_PRIORITY order
+        for column in ([gene_type] if gene_type else self.priority):
+            row_ids = self.row_ids(column, gene_name)
+            if row_ids:
+                return self.record(row_ids[0]), column
+        return None, None
+
+    def lookup_normalized(self, label): # Retries a label that missed exactly, returning (record, matched column, normalization rules)
+        key, gene_type, rules = normalize_label(label)
+        for column in ([gene_type] if gene_type else self.priority):
+            row_ids = self.row_ids(column, key)
+            if not row_ids: # Then snapshot keys that only match once normalized themselves (an alias written "p53")
+                row_ids = self.normalized.get(column, {}).get(key)
+                if row_ids is None:
+                    continue
+                row_ids = (row_ids,) if isinstance(row_ids, int) else row_ids
+                rules = rules + ["snapshot_key"]
+            return self.record(row_ids[0]), column, rules
+        return None, None, rules
+
+    def vocabulary(self, columns): # (key, row id, column) for every single-value key of the given text columns
+        for column in columns:
+            for key, row_ids in self.keys.get(column, {}).items():
+                if ',' not in key:
+                    for row_id in ((row_ids,) if isinstance(row_ids, int) else row_ids):
+                        yield key, row_id, column
+
+    def candidates(self, gene_name, gene_type=None): # Every (record, matched column) for a key, the one lookup picks first
+        if gene_type:
+            return [(self.record(row_id), gene_type) for row_id in self.row_ids(gene_type, gene_name)]
+        if gene_name in self.ambiguous:
+            return [(self.record(row_id), column) for row_id, column in self.ambiguous[gene_name]]
+        record, column = self.lookup(gene_name)
+        return [(record, column)] if record is not None else []
+
+    def frames(self): # Record table plus one (key, record) table per column, built once for batch joins
+        import numpy as np
+        import pandas as pd
+        if self._frames is None:
+            records = pd.DataFrame({column: [self.value(column, row_id) for row_id in range(self.size)] for column in RESULT_COLUMNS},
+                                   dtype=object)
+            key_frames = {column: pd.DataFrame({'key': list(keys), 'record': [row_ids if isinstance(row_ids, int) else row_ids[0] for row_ids in keys.values()]})
+                          for column, keys in self.keys.items()}
+            for column, (codes, order) in self.sorted_ids.items():
+                first = np.unique(codes, return_index=True)[1] # First row for each code, since rows sharing a code are in rank order
+                first = first[codes[first] != 0]
+                key_frames[column] = pd.DataFrame({'key': [self.value(column, row_id) for row_id in order[first]], 'record': order[first]})
+            self._frames = records, key_frames
+        return self._frames
+
+_INDEX_CACHE = {}
+
+def load_index(database_path, persist=False): # Helper function to build the index for a snapshot file once and reuse it while the file is unchanged
+    # With persist=True the index is also saved next to the snapshot (<name>.idx), so later processes load it instead of re-parsing
+    key = (os.path.abspath(database_path), os.path.getmtime(database_path))
+    if key not in _INDEX_CACHE:
+        index_path = f"{os.path.splitext(database_path)[0]}.idx"
+        index = GeneIndex.load(index_path, database_path) if persist else None
+        if index is None:
+            index = GeneIndex.from_file(database_path)
+            if persist:
+                index.save(index_path, database_path)
+        _INDEX_CACHE.clear()
+        _INDEX_CACHE[key] = index
+    return _INDEX_CACHE[key]
+
+MAPPED_MAGIC = b"GNMX"
+MAPPED_VERSION = 3
+NORMALIZED_MARK = b"\x1e" # Key prefix of normalized snapshot keys in a mapped index
+AMBIGUOUS_MARK = b"\x1d" # Key prefix of ambiguous keys and shared IDs in a mapped index
+# magic, version, rows, columns, keys, source size, source mtime_ns, length of the column names, then 7 section offsets
+MAPPED_HEADER = struct.Struct("<4s3I4Q7Q")
+
+def _align(buffer): # Helper function to pad buffer to a multiple of 8 bytes and return the offset of the next section
+    buffer.extend(b"\0" * (-len(buffer) % 8))
+    return len(buffer)
+
+def write_mapped_index(index, path, source): # Writes a GeneIndex as sorted keys plus offset tables that MappedGeneIndex reads in place
+    columns = index.fieldnames
+    postings = {}
+    for position, column in enumerate(columns):
+        if column in index.sorted_ids:
+            codes, order = index.sorted_ids[column]
+            entries = ((index.value(column, row_id), row_id) for code, row_id in zip(codes.tolist(), order.tolist()) if code)
+        else:
+            entries = ((key, row_id) for key, row_ids in index.keys[column].items()
+                       for row_id in ((row_ids,) if isinstance(row_ids, int) else row_ids))
+        for key, row_id in entries:
+            postings.setdefault(key.encode(), []).append((position, row_id))
+        for key, row_ids in index.normalized.get(column, {}).items(): # Stored under a \x1e prefix, apart from the exact keys
+            for row_id in ((row_ids,) if isinstance(row_ids, int) else row_ids):
+                postings.setdefault(NORMALIZED_MARK + key.encode(), []).append((position, row_id))
+    # Under a \x1d prefix, one posting per ID column that shares the key, or column len(columns) when the key is
+    # in index.ambiguous; the row id is unused. MappedGeneIndex reads them back as its ambiguous and ambiguous_ids.
+    for column, ids in index.ambiguous_ids.items():
+        for key in ids:
+            postings.setdefault(AMBIGUOUS_MARK + key.encode(), []).append((columns.index(column), 0))
+    for key in index.ambiguous:
+        postings.setdefault(AMBIGUOUS_MARK + key.encode(), []).append((len(columns), 0))
+    keys = sorted(postings)
+
+    record_offsets, records = array('Q', [0]), bytearray()
+    for row_id in range(index.size):
+        records += "\x1f".join(index.value(column, row_id) or '' for column in columns).encode()
+        record_offsets.append(len(records))
+    key_offsets, key_blob = array('Q', [0]), bytearray()
+    posting_offsets, posting_entries = array('Q', [0]), array('I')
+    for key in keys:
+        key_blob += key
+        key_offsets.append(len(key_blob))
+        for position, row_id in sorted(postings[key], key=lambda posting: (posting[0], index.rank[posting[1]])):
+            posting_entries.extend((position, row_id))
+        posting_offsets.append(len(posting_entries) // 2)
+
+    names = "\x1f".join(columns).encode()
+    buffer = bytearray(MAPPED_HEADER.size)
+    offsets = []
+    for section in (names, record_offsets, records, key_offsets, key_blob, posting_offsets, posting_entries):
+        offsets.append(_align(buffer))
+        buffer += section if isinstance(section, (bytes, bytearray)) else section.tobytes()
+    info = os.stat(source)
+    MAPPED_HEADER.pack_into(buffer, 0, MAPPED_MAGIC, MAPPED_VERSION, index.size, len(columns), len(keys),
+                            info.st_size, info.st_mtime_ns, len(names), *offsets)
+    _atomic_write(path, [bytes(buffer)])
+    return path
+
+class MappedGeneIndex: # Read-only index queried straight from an mmap'd file, so processes on one host share one copy through the page cache
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, self.size, n_columns, self._n_keys, source_size, source_mtime, names_length,
+         names, record_offsets, records, key_offsets, keys, posting_offsets, postings) = MAPPED_HEADER.unpack_from(self._map)
+        if magic != MAPPED_MAGIC or version != MAPPED_VERSION:
+            raise ValueError(f"{path} is not a version {MAPPED_VERSION} mapped gene index")
+        self.source = (source_size, source_mtime)
+        self._index_file = (f"{os.path.splitext(path)[0]}.idx", (INDEX_FORMAT, source_size, source_mtime)) # Written from that GeneIndex, same row ids
+        self.fieldnames = self._map[names:names + names_length].decode().split("\x1f")
+        self.priority = sorted(self.fieldnames, key=lambda column: MATCH_PRIORITY.index(column) if column in MATCH_PRIORITY else len(MATCH_PRIORITY))
+        self._positions = {column: position for position, column in enumerate(self.fieldnames)}
+
+        view = memoryview(self._map)
+        self._record_offsets = view[record_offsets:record_offsets + 8 * (self.size + 1)].cast('Q')
+        self._records = records
+        self._key_offsets = view[key_offsets:key_offsets + 8 * (self._n_keys + 1)].cast('Q')
+        self._keys = keys
+        self._posting_offsets = view[posting_offsets:posting_offsets + 8 * (self._n_keys + 1)].cast('Q')
+        self._postings = view[postings:postings + 8 * self._posting_offsets[self._n_keys]].cast('I')
+
+        self.ambiguous, self.ambiguous_ids = set(), {}
+        for position in range(self._bisect(AMBIGUOUS_MARK), self._n_keys):
+            key = self._key(position)
+            if not key.startswith(AMBIGUOUS_MARK):
+                break
+            key = key[len(AMBIGUOUS_MARK):].decode()
+            start, stop = self._posting_offsets[position], self._posting_offsets[position + 1]
+            for column_id in self._postings[2 * start:2 * stop:2]:
+                if column_id == n_columns:
+                    self.ambiguous.add(key)
+                else:
+                    self.ambiguous_ids.setdefault(self.fieldnames[column_id], set()).add(key)
+
+    def __reduce__(self): # Pickles as its path, so worker processes map the same file instead of copying it
+        return (MappedGeneIndex, (self.path,))
+
+    def _key(self, position):
+        return self._map[self._keys + self._key_offsets[position]:self._keys + self._key_offsets[position + 1]]
+
+    def _bisect(self, key): # Binary search over the sorted keys, returns the position of the first key not below key
+        low, high = 0, self._n_keys
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
             else:
-                for column in columns:
-                    if _contains_gene(row.get(column), gene_name):
-                        result_df = pd.DataFrame([row])
-                        return (*_extract_columns(result_df), [column])
+                high = middle
+        return low
+
+    def _find(self, key): # Position of key, or -1
+        key = key.encode()
+        low = self._bisect(key)
+        return low if low < self._n_keys and self._key(low) == key else -1
+
+    def _row(self, row_id):
+        start, stop = self._record_offsets[row_id], self._record_offsets[row_id + 1]
+        return self._map[self._records + start:self._records + stop].decode().split("\x1f")
+
+    def value(self, column, row_id):
+        position = self._positions.get(column)
+        return (self._row(row_id)[position] or None) if position is not None else None
+
+    def record(self, row_id):
+        row = self._row(row_id)
+        return tuple((row[self._positions[column]] or None) if column in self._positions else None for column in RESULT_COLUMNS)
+
+    def _postings_for(self, key):
+        position = self._find(key)
+        if position < 0:
+            return ()
+        start, stop = self._posting_offsets[position], self._posting_offsets[position + 1]
+        entries = self._postings[2 * start:2 * stop]
+        return list(zip(entries[0::2], entries[1::2]))
+
+    def row_ids(self, column, key):
+        position = self._positions.get(column)
+        return tuple(row_id for column_id, row_id in self._postings_for(key) if column_id == position)
+
+    def lookup(self, gene_name, gene_type=None):
+        postings = self._postings_for(gene_name)
+        for column in ([gene_type] if gene_type else self.priority):
+            position = self._positions.get(column)
+            row_id = next((row_id for column_id, row_id in postings if column_id == position), None)
+            if row_id is not None:
+                return self.record(row_id), column
+        return None, None
+
+    def lookup_normalized(self, label):
+        key, gene_type, rules = normalize_label(label)
+        exact, normalized = self._postings_for(key), self._postings_for(NORMALIZED_MARK.decode() + key)
+        for column in ([gene_type] if gene_type else self.priority):
+            position = self._positions.get(column)
+            row_id = next((row_id for column_id, row_id in exact if column_id == position), None)
+            if row_id is not None:
+                return self.record(row_id), column, rules
+            row_id = next((row_id for column_id, row_id in normalized if column_id == position), None)
+            if row_id is not None:
+                return self.record(row_id), column, rules + ["snapshot_key"]
+        return None, None, rules
+
+    def vocabulary(self, columns):
+        wanted = {self._positions[column]: column for column in columns if column in self._positions}
+        for position in range(self._n_keys):
+            key = self._key(position)
+            if key.startswith((NORMALIZED_MARK, AMBIGUOUS_MARK)) or b',' in key:
+                continue
+            start, stop = self._posting_offsets[position], self._posting_offsets[position + 1]
+            entries = self._postings[2 * start:2 * stop]
+            for column_id, row_id in zip(entries[0::2], entries[1::2]):
+                if column_id in wanted:
+                    yield key.decode(), row_id, wanted[column_id]
+
+    def candidates(self, gene_name, gene_type=None):
+        columns = [gene_type] if gene_type else self.priority
+        ranks = {self._positions[column]: rank for rank, column in enumerate(columns) if column in self._positions}
+        first = {}
+        # Postings are stored in snapshot order within each column, which the stable sort keeps
+        for column_id, row_id in sorted((entry for entry in self._postings_for(gene_name) if entry[0] in ranks), key=lambda entry: ranks[entry[0]]):
+            first.setdefault(row_id, self.fieldnames[column_id])
+        return [(self.record(row_id), column) for row_id, column in first.items()]
+
+def load_mapped_index(database_path): # Helper function to open the mapped index for a snapshot, building <name>.gnmx first if missing or stale
+    mapped_path = f"{os.path.splitext(database_path)[0]}.gnmx"
+    info = os.stat(database_path)
+    try:
+        index = MappedGeneIndex(mapped_path)
+        if index.source == (info.st_size, info.st_mtime_ns):
+            return index
+    except (OSError, ValueError, struct.error):
+        pass
+    write_mapped_index(load_index(database_path, persist=True), mapped_path, database_path)
+    return MappedGeneIndex(mapped_path)
+
+LOCAL_SOURCES = ['gene_info', 'gene_history', 'ensembl_xrefs', 'ensembl_history'] # Local files load_local_index can read
+LOCAL_COLUMNS = ['Approved symbol', 'Previous symbols', 'Alias symbols', 'NCBI Gene ID', 'Ensembl gene ID']
+LOCAL_TAX_ID = "9606" # NCBI taxon kept from gene_info and gene_history, which cover every species
+ENSEMBL_XREF_COLUMNS = {'HGNC ID': 'HGNC ID', 'NCBI gene (formerly Entrezgene) ID': 'NCBI Gene ID', 'Gene name': 'Approved symbol'} # BioMart export headers
+ENSEMBL_XREF_DBS = {'HGNC': 'HGNC ID', 'EntrezGene': 'NCBI Gene ID'} # db_name values of Ensembl's *.entrez.tsv / xref dumps
+
+def _read_local_table(path, tax_id=None): # Helper function to yield the rows of a tab-separated file (gzip or not) as dicts, keeping only tax_id rows when given
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8', newline='') as file:
+        header = file.readline().lstrip('#').rstrip('\r\n').split('\t')
+        prefix = f"{tax_id}\t" if tax_id else ""
+        for line in file:
+            if line.startswith(prefix): # gene_history lists every species; skip the rest before splitting
+                yield dict(zip(header, line.rstrip('\r\n').split('\t')))
+
+def _follow(history, key): # Helper function to follow a withdrawn-to-replacement chain to the ID still current, or None if it ends withdrawn
+    seen = set()
+    while key in history and key not in seen:
+        seen.add(key)
+        key = history[key]
+    return key if key and key not in seen else None
+
+def build_local_snapshot(index, sources, path, tax_id=LOCAL_TAX_ID): # Writes a snapshot-format table of the extra keys that local NCBI and Ensembl files give HGNC genes
+    # One row per approved symbol of index, with LOCAL_COLUMNS: NCBI symbols as previous (withdrawn) or alias (synonyms)
+    # symbols, and every NCBI Gene ID and Ensembl gene ID, current or retired, that leads to the gene. Retired IDs are
+    # followed along gene_history / ensembl_history to the current ID, then linked through its HGNC ID, current ID or symbol.
+    keys = {}
+
+    def target(**values): # Approved symbol of the index gene one of the given identifiers belongs to
+        for column in ('HGNC ID', 'NCBI Gene ID', 'Ensembl gene ID', 'Approved symbol'):
+            value = values.get(column)
+            if value and value != '-':
+                record, _ = index.lookup(value, column)
+                if record is not None:
+                    return record[0]
+        return None
+
+    def add(symbol, column, *values):
+        for value in values:
+            if symbol and value and value not in ('-', symbol):
+                keys.setdefault(symbol, {}).setdefault(column, set()).add(value)
+
+    ncbi_genes, ensembl_genes = {}, {}
+    if sources.get('gene_info'):
+        for row in _read_local_table(sources['gene_info'], tax_id):
+            xrefs = dict(item.split(':', 1) for item in row.get('dbXrefs', '-').split('|') if ':' in item)
+            symbol = target(**{'HGNC ID': xrefs.get('HGNC', '').rpartition(':')[2], 'NCBI Gene ID': row['GeneID'],
+                               'Ensembl gene ID': xrefs.get('Ensembl'), 'Approved symbol': row.get('Symbol_from_nomenclature_authority')})
+            ncbi_genes[row['GeneID']] = symbol
+            add(symbol, 'NCBI Gene ID', row['GeneID'])
+            add(symbol, 'Ensembl gene ID', xrefs.get('Ensembl'))
+            add(symbol, 'Alias symbols', row['Symbol'], *row.get('Synonyms', '-').split('|'))
+    if sources.get('gene_history'):
+        rows = list(_read_local_table(sources['gene_history'], tax_id))
+        history = {row['Discontinued_GeneID']: row['GeneID'] if row['GeneID'] != '-' else None for row in rows}
+        for row in rows:
+            current = _follow(history, row['Discontinued_GeneID'])
+            symbol = ncbi_genes.get(current) or target(**{'NCBI Gene ID': current}) if current else None
+            add(symbol, 'NCBI Gene ID', row['Discontinued_GeneID'])
+            add(symbol, 'Previous symbols', row['Discontinued_Symbol'])
+    if sources.get('ensembl_xrefs'):
+        for row in _read_local_table(sources['ensembl_xrefs']):
+            gene = (row.get('Gene stable ID') or row.get('gene_stable_id') or '').split('.', 1)[0]
+            values = {column: row[header] for header, column in ENSEMBL_XREF_COLUMNS.items() if row.get(header)}
+            if row.get('db_name') in ENSEMBL_XREF_DBS:
+                values[ENSEMBL_XREF_DBS[row['db_name']]] = row['xref']
+            if 'HGNC ID' in values:
+                values['HGNC ID'] = values['HGNC ID'].rpartition(':')[2]
+            symbol = ensembl_genes.get(gene) or target(**values, **{'Ensembl gene ID': gene})
+            ensembl_genes[gene] = symbol
+            add(symbol, 'Ensembl gene ID', gene)
+    if sources.get('ensembl_history'):
+        history = {}
+        for row in _read_local_table(sources['ensembl_history']):
+            old = (row.get('Old stable ID') or row.get('old_stable_id') or '').split('.', 1)[0]
+            new = (row.get('New stable ID') or row.get('new_stable_id') or '').split('.', 1)[0]
+            if old.startswith('ENSG') and old != new:
+                history.setdefault(old, new if new.startswith('ENSG') else None) # A split keeps its first successor
+        for old in history:
+            current = _follow(history, old)
+            add(ensembl_genes.get(current) or target(**{'Ensembl gene ID': current}) if current else None, 'Ensembl gene ID', old)
+
+    def rows():
+        yield "\t".join(LOCAL_COLUMNS) + "\n"
+        for symbol, columns in keys.items():
+            yield "\t".join([symbol] + [", ".join(sorted(columns.get(column, ()))) for column in LOCAL_COLUMNS[1:]]) + "\n"
+    _atomic_write(path, (row.encode() for row in rows()))
+    logging.info(f"Indexed local identifiers for {len(keys)} genes from {', '.join(name for name in LOCAL_SOURCES if sources.get(name))}")
+    return path
+
+_LOCAL_CACHE = {}
+
+def load_local_index(index, database_path, sources, cache_dir=None): # GeneIndex of the local-source keys, built once per set of input files
+    # sources maps LOCAL_SOURCES names to file paths; the table and its index are kept in the cache directory as local_<key>.tsv/.idx
+    signature = [_snapshot_signature(database_path)] + [(name, os.path.abspath(sources[name]), *_snapshot_signature(sources[name])[1:])
+                                                        for name in LOCAL_SOURCES if sources.get(name)]
+    key = hashlib.sha1(json.dumps(signature).encode()).hexdigest()[:16]
+    if key not in _LOCAL_CACHE:
+        path = os.path.join(_cache_dir(cache_dir), f"local_{key}.tsv")
+        local = GeneIndex.load(f"{path[:-4]}.idx", path) if os.path.exists(path) else None
+        if local is None:
+            local = GeneIndex.from_file(build_local_snapshot(index, sources, path))
+            local.save(f"{path[:-4]}.idx", path)
+        _LOCAL_CACHE.clear()
+        _LOCAL_CACHE[key] = local
+    return _LOCAL_CACHE[key]
+
+FUZZY_COLUMNS = ['Approved symbol', 'Previous symbols', 'Alias symbols'] # Vocabulary the fuzzy matcher suggests from
+FUZZY_MAX_DISTANCE = 2 # Default edit-distance threshold for fuzzy suggestions
+FUZZY_SUGGESTIONS = 3 # Suggestions kept per label
+FUZZY_CANDIDATES = 10 # Terms with the most shared trigrams that are checked by edit distance, per label
+# Months Excel turns symbols into dates (MARCH1 -> 1-Mar), with the symbol prefixes each can stand for
+EXCEL_MONTHS = {"MAR": ["MARCH", "MARCHF"], "SEP": ["SEPT", "SEPTIN"], "DEC": ["DEC"], "OCT": ["OCT"], "NOV": ["NOV"]}
+
+def fuzzy_key(value): # normalize_key without punctuation, so C-MYC, c-Myc and CMYC share one key
+    if value.isascii() and value.isalnum():
+        return value.upper()
+    return re.sub(r'[^0-9A-Z]', '', normalize_key(value)[0])
+
+def _gram_codes(terms, length): # Helper function to get the padded trigrams of equal-length ASCII terms as integer codes, one row per term
+    import numpy as np
+    padded = np.frombuffer("".join(f"^^{term}$$" for term in terms).encode(), dtype=np.uint8).reshape(len(terms), length + 4).astype(np.int32)
+    return (padded[:, :-2] << 14) | (padded[:, 1:-1] << 7) | padded[:, 2:]
+
+def _levenshtein(a, b): # Helper function for the edit distance of two strings, computed with bit vectors (Myers/Hyyrö) so it costs O(len(b)) int operations
+    if not a or not b:
+        return len(a) + len(b)
+    equal = {}
+    for i, char in enumerate(a):
+        equal[char] = equal.get(char, 0) | 1 << i
+    full, top = (1 << len(a)) - 1, 1 << (len(a) - 1)
+    positive, negative, distance = full, 0, len(a)
+    for char in b:
+        eq = equal.get(char, 0)
+        vertical = eq | negative
+        horizontal = ((((eq & positive) + positive) & full) ^ positive) | eq
+        up = negative | ~(horizontal | positive) & full
+        down = positive & horizontal
+        if up & top:
+            distance += 1
+        elif down & top:
+            distance -= 1
+        up = (up << 1 | 1) & full
+        down = (down << 1) & full
+        positive = down | ~(vertical | up) & full
+        negative = up & vertical
+    return distance
+
+class FuzzyIndex: # Trigram index over the symbol, previous and alias vocabulary, for ranked near-miss suggestions
+    # Terms are sorted by length and trigrams are integer codes in one posting array ordered by (trigram, term), so a
+    # whole batch of labels is matched with a handful of NumPy calls: each label only expands its rarest trigrams, within
+    # the term lengths it can reach, and the terms sharing the most are checked by edit distance.
+    def __init__(self, index):
+        import numpy as np
+        self.index = index
+        terms = {}
+        for key, row_id, column in index.vocabulary(FUZZY_COLUMNS):
+            term = fuzzy_key(key)
+            if term:
+                found = terms.setdefault(term, {})
+                if row_id not in found or MATCH_PRIORITY.index(column) < MATCH_PRIORITY.index(found[row_id]):
+                    found[row_id] = column
+        self.terms = sorted(terms, key=lambda term: (len(term), term))
+        self.matches = [tuple(sorted(terms[term].items())) for term in self.terms] # By row id, so every index type builds the same
+        self.term_ids = {term: term_id for term_id, term in enumerate(self.terms)}
+        lengths = np.array([len(term) for term in self.terms])
+        self.length_starts = np.searchsorted(lengths, np.arange(lengths.max(initial=0) + 2))
+
+        codes, term_ids = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+        for length in range(1, len(self.length_starts) - 1):
+            start, stop = self.length_starts[length], self.length_starts[length + 1]
+            if stop > start:
+                codes.append(_gram_codes(self.terms[start:stop], length).ravel())
+                term_ids.append(np.repeat(np.arange(start, stop), length + 2))
+        codes, term_ids = np.concatenate(codes), np.concatenate(term_ids)
+        order = np.lexsort((term_ids, codes))
+        codes, term_ids = codes[order], term_ids[order]
+        self.gram_codes, first, self.gram_sizes = np.unique(codes, return_index=True, return_counts=True)
+        # (trigram position, term id) as one sorted int64, so a term-length window of any posting list is one searchsorted
+        self.gram_keys = np.repeat(np.arange(len(self.gram_codes), dtype=np.int64), self.gram_sizes) * len(self.terms) + term_ids
+
+    def save(self, path, signature): # Adds the arrays to the saved index file at path, unless that file was replaced meanwhile
+        import io
+        import zipfile
+        import numpy as np
+        with open(path, 'rb') as file:
+            buffer = io.BytesIO(file.read())
+        with np.load(buffer, allow_pickle=False) as data:
+            if tuple(data['signature'].tolist()) != signature or 'fuzzy_terms' in data.files:
+                return
+        columns = [FUZZY_COLUMNS.index(column) for matches in self.matches for _, column in matches]
+        arrays = {'terms': np.frombuffer("\n".join(self.terms).encode(), dtype=np.uint8),
+                  'match_starts': np.cumsum([0] + [len(matches) for matches in self.matches]),
+                  'match_rows': np.array([row_id for matches in self.matches for row_id, _ in matches], dtype=np.int64),
+                  'match_columns': np.array(columns, dtype=np.int8), 'length_starts': self.length_starts,
+                  'gram_codes': self.gram_codes, 'gram_sizes': self.gram_sizes, 'gram_keys': self.gram_keys}
+        with zipfile.ZipFile(buffer, 'a') as archive: # The index file is an npz, so the arrays go in as more of its members
+            for name, values in arrays.items():
+                with archive.open(f"fuzzy_{name}.npy", 'w') as member:
+                    np.lib.format.write_array(member, np.asarray(values), allow_pickle=False)
+        _atomic_write(path, [buffer.getvalue()])
+
+    @classmethod
+    def load(cls, index, path, signature): # Reads the arrays save added for index, or returns None if they are missing or stale
+        import numpy as np
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if tuple(data['signature'].tolist()) != signature or 'fuzzy_terms' not in data.files:
+                    return None
+                fuzzy = cls.__new__(cls)
+                fuzzy.index = index
+                blob = data['fuzzy_terms'].tobytes().decode()
+                fuzzy.terms = blob.split("\n") if blob else []
+                starts, rows = data['fuzzy_match_starts'].tolist(), data['fuzzy_match_rows'].tolist()
+                columns = [FUZZY_COLUMNS[column] for column in data['fuzzy_match_columns'].tolist()]
+                fuzzy.length_starts, fuzzy.gram_codes = data['fuzzy_length_starts'], data['fuzzy_gram_codes']
+                fuzzy.gram_sizes, fuzzy.gram_keys = data['fuzzy_gram_sizes'], data['fuzzy_gram_keys']
+        except Exception as e: # A damaged file is rebuilt like a missing one
+            if not isinstance(e, FileNotFoundError):
+                logging.info(f"Ignoring fuzzy arrays in {path}: {e!r}")
+            return None
+        pairs = list(zip(rows, columns))
+        fuzzy.matches = [tuple(pairs[start:stop]) for start, stop in zip(starts, starts[1:])]
+        fuzzy.term_ids = {term: term_id for term_id, term in enumerate(fuzzy.terms)}
+        return fuzzy
+
+    @staticmethod
+    def limit_for(term, max_distance): # Edits allowed for a term: none below 3 characters, then one per 4 characters up to max_distance
+        return 0 if len(term) < 3 else min(max_distance, max(1, len(term) // 4))
+
+    def _near_many(self, terms, limits): # [{term id: distance}] for each term, within its limit
+        import numpy as np
+        near = [{} for _ in terms]
+        queries = [query for query, (term, limit) in enumerate(zip(terms, limits)) if limit > 0]
+        if not queries or not self.terms:
+            return near
+        n_terms, longest = len(self.terms), len(self.length_starts) - 1
+
+        # Distinct trigrams of every query, with how many terms hold each (0 when no term does)
+        query_ids, codes = [], []
+        for length in {len(terms[query]) for query in queries}:
+            group = [query for query in queries if len(terms[query]) == length]
+            query_ids.append(np.repeat(np.array(group), length + 2))
+            codes.append(_gram_codes([terms[query] for query in group], length).ravel())
+        pairs = np.unique(np.concatenate(query_ids) << 21 | np.concatenate(codes))
+        query_ids, codes = pairs >> 21, pairs & ((1 << 21) - 1)
+        positions = np.minimum(np.searchsorted(self.gram_codes, codes), len(self.gram_codes) - 1)
+        found = self.gram_codes[positions] == codes
+        sizes = np.where(found, self.gram_sizes[positions], 0)
+
+        # An edit breaks at most 3 of the query's trigrams, so a term within d edits shares one of its rarest 3d + 1 and at
+        # least len + 2 - 3d in all; only the rare posting lists are expanded, then the rest are checked per candidate
+        lengths = np.array([len(term) for term in terms])
+        limits = np.array(limits)
+        order = np.lexsort((sizes, query_ids))
+        query_ids, positions, found = query_ids[order], positions[order], found[order]
+        distinct = np.bincount(query_ids, minlength=len(terms))
+        rare = np.arange(len(query_ids)) - np.searchsorted(query_ids, query_ids) < 3 * limits[query_ids] + 1
+        lo = self.length_starts[np.clip(lengths - limits, 0, longest)]
+        hi = self.length_starts[np.clip(lengths + limits + 1, 0, longest)]
+
+        expand = rare & found
+        starts = np.searchsorted(self.gram_keys, positions[expand] * n_terms + lo[query_ids[expand]])
+        counts = np.searchsorted(self.gram_keys, positions[expand] * n_terms + hi[query_ids[expand]]) - starts
+        offsets = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        hits, shared = np.unique(np.repeat(query_ids[expand], counts) * n_terms + self.gram_keys[offsets] % n_terms, return_counts=True)
+        hit_queries, hit_terms = hits // n_terms, hits % n_terms
+
+        others = ~rare & found # Add the candidate's share of the query's remaining trigrams
+        other_queries, other_positions = query_ids[others], positions[others]
+        other_counts = np.bincount(other_queries, minlength=len(terms))
+        per_hit = other_counts[hit_queries]
+        hit_of = np.repeat(np.arange(len(hits)), per_hit)
+        other_of = np.repeat(np.searchsorted(other_queries, hit_queries) - np.cumsum(per_hit) + per_hit, per_hit) + np.arange(per_hit.sum())
+        keys = other_positions[other_of] * n_terms + hit_terms[hit_of]
+        held = self.gram_keys[np.minimum(np.searchsorted(self.gram_keys, keys), len(self.gram_keys) - 1)] == keys
+        shared += np.bincount(hit_of[held], minlength=len(hits))
+
+        # The FUZZY_CANDIDATES terms over the bound sharing most trigrams with each query are checked by edit distance
+        keep = shared >= distinct[hit_queries] - 3 * limits[hit_queries]
+        hit_queries, hit_terms, shared = hit_queries[keep], hit_terms[keep], shared[keep]
+        order = np.lexsort((-shared, hit_queries))
+        hit_queries, hit_terms = hit_queries[order], hit_terms[order]
+        top = np.arange(len(hit_queries)) - np.searchsorted(hit_queries, hit_queries) < FUZZY_CANDIDATES
+        for query, term_id in zip(hit_queries[top].tolist(), hit_terms[top].tolist()):
+            distance = _levenshtein(terms[query], self.terms[term_id])
+            if distance <= limits[query]:
+                near[query][term_id] = distance
+        for query in queries: # A swap of two neighbouring characters counts as one edit, not two
+            term = terms[query]
+            for i in range(len(term) - 1):
+                swapped = term[:i] + term[i + 1] + term[i] + term[i + 2:]
+                if swapped != term and swapped in self.term_ids:
+                    near[query][self.term_ids[swapped]] = 1
+        return near
+
+    def suggest_many(self, labels, max_distance=FUZZY_MAX_DISTANCE, limit=FUZZY_SUGGESTIONS): # suggest for many labels in one pass
+        terms = [fuzzy_key(label) for label in labels]
+        near = [{} for _ in labels]
+        for query, (label, term) in enumerate(zip(labels, terms)):
+            date = re.fullmatch(r'0?(\d{1,2})-?([A-Z]{3})|([A-Z]{3})-?0?(\d{1,2})', normalize_key(label)[0]) # Excel dates such as 1-Mar or Sep-02
+            if date:
+                day, month = (date.group(1), date.group(2)) if date.group(1) else (date.group(4), date.group(3))
+                for prefix in EXCEL_MONTHS.get(month, ()):
+                    if f"{prefix}{day}" in self.term_ids:
+                        near[query][self.term_ids[f"{prefix}{day}"]] = 0
+            if term in self.term_ids:
+                near[query][self.term_ids[term]] = 0
+        limits = [0 if near[query] else self.limit_for(term, max_distance) for query, term in enumerate(terms)]
+        for query, found in enumerate(self._near_many(terms, limits)):
+            near[query].update(found)
+
+        suggestions = []
+        for query in range(len(labels)):
+            best = {}
+            for term_id, distance in near[query].items():
+                for row_id, column in self.matches[term_id]:
+                    rank = (distance, MATCH_PRIORITY.index(column), self.terms[term_id])
+                    if row_id not in best or rank < best[row_id][0]:
+                        best[row_id] = (rank, column)
+            ranked = sorted(best.items(), key=lambda item: item[1][0])[:limit]
+            suggestions.append([(self.index.record(row_id), column, rank[0]) for row_id, (rank, column) in ranked])
+        return suggestions
+
+    def suggest(self, label, max_distance=FUZZY_MAX_DISTANCE, limit=FUZZY_SUGGESTIONS): # Ranked [(record, column, distance)] for a label, best first
+        return self.suggest_many([label], max_distance, limit)[0]
+
+_FUZZY_CACHE = {}
+
+def get_fuzzy_index(index): # Helper function to build the FuzzyIndex of an index once and reuse it while that index is current
+    # An index saved to a file keeps the arrays in that file too, so later processes load them instead of rebuilding
+    fuzzy = _FUZZY_CACHE.get(id(index))
+    if fuzzy is None or fuzzy.index is not index:
+        _FUZZY_CACHE.clear()
+        fuzzy = FuzzyIndex.load(index, *index._index_file) if index._index_file else None
+        if fuzzy is None:
+            fuzzy = FuzzyIndex(index)
+            if index._index_file:
+                try:
+                    fuzzy.save(*index._index_file)
+                except OSError as e:
+                    logging.info(f"Could not save fuzzy arrays to {index._index_file[0]}: {e}")
+        _FUZZY_CACHE[id(index)] = fuzzy
+    return fuzzy
+
+def search_single_gene(database, gene_name, all_matches=False): # database is a GeneIndex, a MappedGeneIndex or the path of a downloaded snapshot
+    # With all_matches=True every candidate gene is returned, one list item each, with its own match type
+    label = gene_name
+    gene_name, gene_type = transform_string(gene_name)
+    index = database if isinstance(database, (GeneIndex, MappedGeneIndex)) else load_index(database)
+
+    if all_matches:
+        found = index.candidates(gene_name, gene_type)
+        return tuple([record[i] for record, _ in found] for i in range(len(RESULT_COLUMNS))) + ([column for _, column in found],)
+    record, column = index.lookup(gene_name, gene_type)
+    if record is None:
+        record, column, _ = _lookup_normalized(index, label)
+    if record is not None:
+        return ([record[0]], [record[1]], [record[2]], [record[3]], [column])
     # If no match found
-    empty = pd.Series(dtype=str)
-    return empty, empty, empty, empty, []
+    return [], [], [], [], []
     
 
 def _parse_json(response, label): # Helper function to parse a json
@@ -119,55 +1369,162 @@ def _extract_record(data): # Helper function to get records
             return docs[0]
     return None
 
-def getData(URL, label):
+HGNC_REST_URL = "https://rest.genenames.org"
+API_RATE_LIMIT = 10 # Requests per second allowed by the HGNC REST service
+API_WORKERS = 8 # Threads used to resolve unmatched labels through the API
+
+class TokenBucket: # Thread-safe token bucket, shared by all API calls so concurrent workers stay within API_RATE_LIMIT
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self): # Blocks until a token is available
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_RATE_LIMITER = TokenBucket(API_RATE_LIMIT)
+
+API_CACHE_HIT_TTL = 30 * 24 * 60 * 60 # Seconds a cached REST record is reused
+API_CACHE_MISS_TTL = 24 * 60 * 60 # Seconds a cached "not found" is reused before the label is queried again
+
+class ApiCache: # Persistent SQLite cache of REST lookups keyed by URL, storing misses as well as hits
+    def __init__(self, path, hit_ttl=API_CACHE_HIT_TTL, miss_ttl=API_CACHE_MISS_TTL):
+        self.path = path
+        self.hit_ttl = hit_ttl
+        self.miss_ttl = miss_ttl
+        self._local = threading.local()
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS responses (url TEXT PRIMARY KEY, record TEXT, stored_at REAL NOT NULL)")
+
+    def _connect(self): # One connection per thread; WAL mode lets other processes read while one writes
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, url): # Returns (found, record), where record is None for a cached miss
+        row = self._connect().execute("SELECT record, stored_at FROM responses WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return False, None
+        record, stored_at = row
+        ttl = self.hit_ttl if record is not None else self.miss_ttl
+        if time.time() - stored_at > ttl:
+            return False, None
+        return True, (json.loads(record) if record is not None else None)
+
+    def put(self, url, record):
+        with self._connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+                               (url, json.dumps(record) if record is not None else None, time.time()))
+
+    def purge(self, expired_only=True): # Deletes expired entries (or everything) and returns how many were removed
+        now = time.time()
+        with self._connect() as connection:
+            if expired_only:
+                cursor = connection.execute(
+                    "DELETE FROM responses WHERE (record IS NOT NULL AND stored_at < ?) OR (record IS NULL AND stored_at < ?)",
+                    (now - self.hit_ttl, now - self.miss_ttl))
+            else:
+                cursor = connection.execute("DELETE FROM responses")
+        return cursor.rowcount
+
+    def stats(self):
+        now = time.time()
+        hits, misses, expired = self._connect().execute(
+            "SELECT COUNT(record), COUNT(*) - COUNT(record), "
+            "SUM(CASE WHEN (record IS NOT NULL AND stored_at < ?) OR (record IS NULL AND stored_at < ?) THEN 1 ELSE 0 END) FROM responses",
+            (now - self.hit_ttl, now - self.miss_ttl)).fetchone()
+        return {"path": self.path, "hits": hits, "misses": misses, "expired": expired or 0, "bytes": os.path.getsize(self.path)}
+
+_API_CACHES = {}
+
+def get_api_cache(cache_dir=None): # Helper function to get the shared ApiCache stored alongside the snapshot cache
+    path = os.path.join(_cache_dir(cache_dir), "hgnc_rest.sqlite")
+    if path not in _API_CACHES:
+        _API_CACHES[path] = ApiCache(path)
+    return _API_CACHES[path]
+
+def _extract_search(data): # Helper function to get the search response, with numFound 0 when nothing matched
+    return data.get("response", {"numFound": 0, "docs": []})
+
+def getData(URL, label, cache=None, extract=_extract_record, stats=None):
+    if cache is not None:
+        found, record = cache.get(URL)
+        if found:
+            if stats:
+                stats.count("api_cache_hits")
+            return record
+
     headers = {"Accept": "application/json"}
+    start = time.perf_counter()
     try:
-        response = requests.get(URL, headers=headers)
+        response = http_get(URL, headers=headers, rate_limiter=_RATE_LIMITER, stats=stats)
     except Exception as e:
         logging.info(f"Exception occurred while querying HGNC for {label}: {e}")
-        time.sleep(0.1)
         return None
 
+    finally:
+        if stats:
+            stats.count("api_calls")
+            stats.record_latency(time.perf_counter() - start)
+
     if response.status_code != 200:
         logging.info(f"API returned error status code: {response.status_code} for gene symbol '{label}'")
-        time.sleep(0.1)
         return None
 
     data = _parse_json(response, label)
     
     if data is None:
-        time.sleep(0.1)
         return None
-    record = _extract_record(data)
-    if record:
-        return record
-
-    # If nothing is found
-    return None
+    record = extract(data)
+    if cache is not None: # Only answers from the service are cached; errors above are retried on the next run
+        cache.put(URL, record)
+    return record
 
-def find_API(label):
+def find_API(label, cache=None, stats=None):
     label, Type = transform_string(label)
     label = quote(label, safe='')
 
     headers = {"Accept": "application/json"}
     ENDPOINTS = [
-    ("Approved symbol", "https://rest.genenames.org/fetch/symbol/"),
-    ("Alias gene symbol", "https://rest.genenames.org/fetch/alias_symbol/"),
-    ("Alias name", "https://rest.genenames.org/fetch/alias_name/"),
-    ("Previous HGNC symbol", "https://rest.genenames.org/fetch/prev_symbol/")]
+    ("Approved symbol", f"{HGNC_REST_URL}/fetch/symbol/"),
+    ("Alias gene symbol", f"{HGNC_REST_URL}/fetch/alias_symbol/"),
+    ("Alias name", f"{HGNC_REST_URL}/fetch/alias_name/"),
+    ("Previous HGNC symbol", f"{HGNC_REST_URL}/fetch/prev_symbol/")]
 
 
     data = None
     if Type == "Ensembl gene ID":
-        URL = f"https://rest.genenames.org/fetch/ensembl_gene_id/{label}"
-        data = getData(URL, label)
+        URL = f"{HGNC_REST_URL}/fetch/ensembl_gene_id/{label}"
+        data = getData(URL, label, cache, stats=stats)
     elif Type == "NCBI Gene ID":
-        URL = f"https://rest.genenames.org/fetch/entrez_id/{label}"
-        data = getData(URL, label)
+        URL = f"{HGNC_REST_URL}/fetch/entrez_id/{label}"
+        data = getData(URL, label, cache, stats=stats)
     elif Type == "HGNC ID":
-        URL = f"https://rest.genenames.org/fetch/hgnc_id/{label}"
-        data = getData(URL, label)
-    
+        URL = f"{HGNC_REST_URL}/fetch/hgnc_id/{label}"
+        data = getData(URL, label, cache, stats=stats)
+    else:
+        for _, endpoint in ENDPOINTS: # Symbols are tried as approved, alias and previous symbols in turn
+            data = getData(f"{endpoint}{label}", label, cache, stats=stats)
+            if data:
+                break
+
+    return _api_result(data)
+
+def _api_result(data): # Helper function to shape a REST record (or None) as find_API's return value
     if data:
         a_sym = [data.get('symbol')]
         a_name = [data.get('name')]
@@ -179,10 +1536,115 @@ def find_API(label):
         p_sym = [None]
         alias = [None]
 
-    time.sleep(0.1)
     return a_sym, a_name, p_sym, alias
 
+API_SEARCH_BATCH = 25 # Labels combined into one boolean search query
+# REST fields searched for each label type, in the order find_API tries its endpoints
+SEARCH_FIELDS = {
+    "HGNC ID": ["hgnc_id"],
+    "Ensembl gene ID": ["ensembl_gene_id"],
+    "NCBI Gene ID": ["entrez_id"],
+    None: ["symbol", "alias_symbol", "alias_name", "prev_symbol"]}
+
+def _search_value(label): # Helper function to get the value a REST record holds for a label, and the fields to look in
+    label, Type = transform_string(label)
+    return (f"HGNC:{label}" if Type == "HGNC ID" else label), SEARCH_FIELDS[Type]
+
+def _search_clause(field, value): # Helper function to build an exact-match search clause with the value quoted
+    value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'{field}:"{value}"'
+
+def _record_has(record, field, value): # Helper function to check a REST field (string, number or list) for value, ignoring case
+    field_value = record.get(field)
+    values = field_value if isinstance(field_value, list) else [field_value]
+    return any(str(item).casefold() == value.casefold() for item in values if item is not None)
+
+def _label_key(label): # Helper function to key the cached answer of one label searched by find_API_batch
+    return f"{HGNC_REST_URL}/search-label/{quote(label, safe='')}"
+
+def find_API_batch(labels, cache=None, max_workers=API_WORKERS, stats=None, on_done=None): # Resolves labels with batched searches plus one fetch per hit
+    # on_done, if given, is called from the calling thread with each group of labels as soon as their answers are final.
+    # The cache keeps each label's answer (its HGNC ID, or None for a miss) rather than the search URL, so a label answered
+    # within its TTL is never searched again, whatever panel it comes with; only the other labels are batched.
+    labels = list(dict.fromkeys(labels))
+    cached = {}
+    if cache is not None:
+        for label in labels:
+            found, hgnc_id = cache.get(_label_key(label))
+            if found:
+                cached[label] = hgnc_id
+        if stats:
+            stats.count("api_cache_hits", len(cached))
+    uncached = [label for label in labels if label not in cached]
+    groups = [uncached[i:i + API_SEARCH_BATCH] for i in range(0, len(uncached), API_SEARCH_BATCH)]
+
+    def search(group): # Not cached as a whole; each label's answer is cached below
+        clauses = []
+        for label in group:
+            value, fields = _search_value(label)
+            clauses.extend(_search_clause(field, value) for field in fields)
+        query = quote(" OR ".join(clauses), safe='')
+        return getData(f"{HGNC_REST_URL}/search/{query}", f"search for {len(group)} labels", None, extract=_extract_search, stats=stats)
+
+    def submit(function, item): # Helper function to queue function(item) in the pool, counting queued and finished requests for progress
+        if stats:
+            stats.count("api_queued")
+
+        def task():
+            try:
+                return function(item)
+            finally:
+                if stats:
+                    stats.count("api_done")
+        return executor.submit(task)
+
+    def report(block): # Helper function to pass on_done the leading groups whose requests have all finished (all of them if block)
+        while waiting and (block or all(future.done() for future in waiting[0][1])):
+            group, futures = waiting.pop(0)
+            wait(futures)
+            if on_done:
+                on_done(group)
+
+    def fetch_all(group, ids): # Helper function to queue a fetch for each HGNC ID not fetched yet and wait on the group's fetches
+        for hgnc_id in ids:
+            if hgnc_id not in fetches:
+                fetches[hgnc_id] = submit(fetch, hgnc_id)
+        waiting.append((group, [fetches[hgnc_id] for hgnc_id in ids]))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        searches = [submit(search, group) for group in groups]
+        hits, fetches, fallback, waiting, failed = {}, {}, {}, [], set()
+        fetch = lambda hgnc_id: getData(f"{HGNC_REST_URL}/fetch/hgnc_id/{quote(hgnc_id, safe='')}", hgnc_id, cache, stats=stats)
+        hits.update((label, [hgnc_id] if hgnc_id else []) for label, hgnc_id in cached.items())
+        if cached:
+            fetch_all(list(cached), [hgnc_id for hgnc_id in cached.values() if hgnc_id])
+        for group, future in zip(groups, searches): # Each distinct hit is fetched as soon as the search naming it answers
+            response = future.result()
+            docs = response.get("docs", []) if response else []
+            if response and response["numFound"] > len(docs): # Truncated result list, so look these labels up one at a time
+                fallback.update((label, submit(partial(find_API, cache=cache, stats=stats), label)) for label in group)
+                waiting.append((group, [fallback[label] for label in group]))
+            else:
+                if response is None: # A failed request, answered as a miss this time but not cached
+                    failed.update(group)
+                hits.update((label, [doc["hgnc_id"] for doc in docs]) for label in group)
+                fetch_all(group, [doc["hgnc_id"] for doc in docs])
+            report(block=False)
+        report(block=True)
+        records = {hgnc_id: future.result() for hgnc_id, future in fetches.items()}
+        results = {label: future.result() for label, future in fallback.items()}
+
+    for label, ids in hits.items():
+        value, fields = _search_value(label)
+        candidates = [records[hgnc_id] for hgnc_id in ids if records.get(hgnc_id)]
+        record = next((record for field in fields for record in candidates if _record_has(record, field, value)), None)
+        results[label] = _api_result(record)
+        if cache is not None and label not in cached and label not in failed and len(candidates) == len(ids): # Every fetch answered
+            cache.put(_label_key(label), record.get('hgnc_id') if record else None)
+    return results
+
 def _insert_result_columns(df, name_col): # Helper function to insert result columns into df
+    import pandas as pd
     position = df.columns.get_loc(name_col)
     new_columns = pd.DataFrame({
         'Approved symbol': [None] * len(df),
@@ -193,100 +1655,832 @@ def _insert_result_columns(df, name_col): # Helper function to insert result col
         df.insert(position + 1 + i, col, new_columns[col])
     return df
 
-def _assign_gene_names(df, idx, aSym, aName, pSym, alias): # Helper function to safely assign gene data to correct row
-    if aSym is not None and len(aSym) > 0 and aSym[0]:
-        df.at[idx, 'Approved symbol'] = aSym[0]
-    if aName is not None and len(aName) > 0 and aName[0]:
-        df.at[idx, 'Approved name'] = aName[0]
-    if pSym is not None and len(pSym) > 0 and pSym[0]:
-        df.at[idx, 'Previous symbols'] = pSym[0]
-    if alias is not None and len(alias) > 0 and alias[0]:
-        df.at[idx, 'Alias symbols'] = alias[0]
-
-def _handle_multiple_matches(name, match_types, aSym, aName, pSym, alias): # Helper function to log details for multiple matches
-    logging.info(f"  Multiple entries found for {name}")
-    for i in range(len(aSym)):
-        if match_types[i] == 'Approved symbol':
-            match = aSym[i]
-        elif match_types[i] == 'Approved name':
-            match = aName[i]
-        elif match_types[i] == 'Previous symbols':
-            match = pSym[i]
-        elif match_types[i] == 'Alias symbols':
-            match = alias[i]
+def _api_value(value): # Helper function to flatten an API field (a string or a list of strings) into the snapshot's ", " format
+    if isinstance(value, list):
+        return ", ".join(value) if value else None
+    return value or None
+
+def _resolve_with_api(labels, max_workers=API_WORKERS, cache=None, stats=None, on_done=None): # Helper function to look up distinct labels through batched API searches
+    unique = list(dict.fromkeys(labels))
+    for label in unique:
+        logging.info(f"Entry not in downloaded database, using API: {label}")
+    results = find_API_batch(unique, cache, max_workers, stats, on_done)
+
+    found = {}
+    for label in unique:
+        result = results[label]
+        api_values = [_api_value(value[0]) for value in result]
+        if api_values[0]:
+            found[label] = api_values
         else:
-            match = None
-        logging.info(f"    Match {i+1}: {name} is a {match_types[i]} for {aSym[i]}")
+            logging.info(f"Unmatched entry found for gene: {label}")
+    if stats:
+        stats.count("api_labels", len(unique))
+        stats.count("api_hits", len(found))
+    return found
 
-def process_multiple_names(df, idx, name_str, path): # Helper function for if there are multiple entries seperated by a comma
-    gene_names = [n.strip() for n in name_str.split(',') if n.strip()]
-    aSym_set, aName_set, pSym_set, alias_set = set(), set(), set(), set()
-    matched = False
+def _match_offline(keys, types, index): # Helper function to join labels against the snapshot one identifier kind at a time, in priority order
+    import numpy as np
+    import pandas as pd
+    records, key_frames = index.frames()
+    record = np.full(len(keys), -1)
+    match_type = np.full(len(keys), None, dtype=object)
+    queries = pd.DataFrame({'key': keys.to_numpy(), 'position': np.arange(len(keys))})
+    types = types.to_numpy()
+    for column in index.priority:
+        pending = (record < 0) & (pd.isna(types) | (types == column))
+        if not pending.any():
+            continue
+        hits = queries[pending].merge(key_frames[column], on='key')
+        record[hits['position'].to_numpy()] = hits['record'].to_numpy()
+        match_type[hits['position'].to_numpy()] = column
+    return record, match_type
 
-    for gene in gene_names:
-        aSym, aName, pSym, alias, _ = search_single_gene(path, gene)
-        found = len(aSym.index) > 0 if hasattr(aSym, "index") else bool(aSym and aSym[0])
-        
-        if not found:
-            aSym, aName, pSym, alias = find_API(gene)
-            found = bool(aSym and aSym[0])
+def _collapse_rows(values, rows, multi, n_rows): # Helper function to fold per-label results back into one result per input row
+    import pandas as pd
+    columns = RESULT_COLUMNS + [column for column in values.columns if column not in RESULT_COLUMNS + ['matched']] # e.g. suggestions
+    result = pd.DataFrame(None, index=range(n_rows), columns=RESULT_COLUMNS + ['matching_status'] + columns[len(RESULT_COLUMNS):], dtype=object)
+    result['matching_status'] = "un-matched"
+    values = values.assign(row=rows)
+    is_multi = multi[rows]
 
-        if found:
-            matched = True
-            if aSym is not None and len(aSym) > 0 and aSym[0]:
-                aSym_set.add(aSym[0])
-            if aName is not None and len(aName) > 0 and aName[0]:
-                aName_set.add(aName[0])
-            if pSym is not None and len(pSym) > 0 and pSym[0]:
-                pSym_set.add(pSym[0])
-            if alias is not None and len(alias) > 0 and alias[0]:
-                alias_set.add(alias[0])
-
-    # Assign unique values (or empty string if none)
-    df.at[idx, 'Approved symbol'] = "; ".join(sorted(aSym_set)) if aSym_set else ""
-    df.at[idx, 'Approved name'] = "; ".join(sorted(aName_set)) if aName_set else ""
-    df.at[idx, 'Previous symbols'] = "; ".join(sorted(pSym_set)) if pSym_set else ""
-    df.at[idx, 'Alias symbols'] = "; ".join(sorted(alias_set)) if alias_set else ""
-
-    df.at[idx, 'matching_status'] = "matched" if matched else "un-matched"
-        
-def process_row(df, idx, name, path): # Helper function to process a row by firstly using the downloaded database, and API otherwise
-    aSym, aName, pSym, alias, match_types = search_single_gene(path, name)
-
-    if len(aSym.index) == 0:
-        logging.info(f"Entry not in downloaded database, using API: {name}")
-        aSym, aName, pSym, alias = find_API(name)
-        if aSym is not None and len(aSym) > 0 and aSym[0]:
-            df.at[idx, 'matching_status'] = "matched"
-        else:
-            logging.info(f"Unmatched entry found for gene: {name}")
-            df.at[idx, 'matching_status'] = "un-matched"
+    single = values[~is_multi].set_index('row')
+    result.loc[single.index, columns] = single[columns].to_numpy()
+    result.loc[single.index[single['matched'].to_numpy()], 'matching_status'] = "matched"
+
+    # Rows holding a comma-separated list get the sorted unique values of all their genes joined with "; "
+    listed = values[is_multi]
+    if len(listed): # Grouped in plain Python: a pandas groupby-agg calls back into Python once per row and column anyway
+        groups = {}
+        for row, *cells in zip(listed['row'].to_numpy(), *(listed[column].to_numpy() for column in columns + ['matched'])):
+            groups.setdefault(row, []).append(cells)
+        joined = [["; ".join(sorted({cells[i] for cells in group if isinstance(cells[i], str)})) for i in range(len(columns))]
+                  + ["matched" if any(cells[-1] for cells in group) else "un-matched"] for group in groups.values()]
+        result.loc[list(groups), columns + ['matching_status']] = joined
+    return result
+
+def _row_progress(labels, rows, n_rows, stats): # Helper function to count rows in stats as they finish, returning the callback to call with labels once answered
+    # labels/rows pair each label still waiting for an answer with a row holding it; every other row is counted at once
+    waiting, rows_of = {}, {}
+    for label, row in set(zip(labels, rows)):
+        waiting[row] = waiting.get(row, 0) + 1
+        rows_of.setdefault(label, []).append(row)
+    stats.count("rows", n_rows - len(waiting))
+
+    def done(answered):
+        finished = 0
+        for label in answered:
+            for row in rows_of.pop(label, ()):
+                waiting[row] -= 1
+                finished += not waiting[row]
+        stats.count("rows", finished)
+    return done
+
+def _lookup_normalized(index, label, stats=None): # Helper function to retry an exact miss with normalize_label, logging and counting which rules matched
+    record, column, rules = index.lookup_normalized(label)
+    if record is not None:
+        logging.info(f"Matched {label} to {record[0]} by {column} after normalization: {', '.join(rules) or 'none'}")
+        if stats:
+            stats.count(f"normalized_hits:{'+'.join(rules) or 'none'}")
+    return record, column, rules
+
+def _match_labels(labels, index, stats=None): # Helper function to look labels up in the snapshot, returning the result columns and a matched flag per label
+    import numpy as np
+    import pandas as pd
+    stats = stats or RunStats()
+    with stats.timer("classification"):
+        keys, types = classify_labels(labels)
+    if isinstance(index, MappedGeneIndex): # No join tables in a mapped index, so it is queried label by label
+        with stats.timer("offline_match"):
+            found = [index.lookup(key, gene_type if isinstance(gene_type, str) else None)[0] for key, gene_type in zip(keys, types)]
+        values = pd.DataFrame([record or (None,) * len(RESULT_COLUMNS) for record in found], columns=RESULT_COLUMNS, dtype=object)
+        values['matched'] = [record is not None for record in found]
     else:
-        df.at[idx, 'matching_status'] = "matched"
-        if len(aSym.index) > 1:
-            _handle_multiple_matches(name, match_types, aSym, aName, pSym, alias)
-    _assign_gene_names(df, idx, aSym, aName, pSym, alias)
+        with stats.timer("offline_match"):
+            record, match_type = _match_offline(keys, types, index)
+        records, _ = index.frames()
+        values = records.iloc[np.maximum(record, 0)].reset_index(drop=True)
+        values.loc[record < 0, RESULT_COLUMNS] = None
+        values['matched'] = record >= 0
 
-def convert_gene_names(df_original, name_col, to_return, output_name = 'results'):    
-    setup_logging(output_name)
-    columns_needed = addColumns(df_original, name_col)
-    path = makeAndFetchURL(columns_needed)
+    with stats.timer("normalized_match"): # Exact misses only, so the common case pays nothing
+        hits = {}
+        for position in np.flatnonzero(~values['matched'].to_numpy()):
+            record = _lookup_normalized(index, labels.iat[position], stats)[0]
+            if record is not None:
+                hits[position] = record
+        if hits:
+            values.loc[list(hits), RESULT_COLUMNS] = list(hits.values())
+            values.loc[list(hits), 'matched'] = True
+    return values
+
+def _match_local(labels, local, index): # Helper function to look unmatched labels up in a load_local_index index, returning {position: index record}
+    keys, types = classify_labels(labels)
+    found = {}
+    for position, label, key, gene_type in zip(labels.index, labels, keys, types):
+        for column in ([gene_type] if isinstance(gene_type, str) else local.priority):
+            row_ids = local.row_ids(column, key)
+            if row_ids: # The local row names the gene; its result columns come from the snapshot itself
+                symbol = local.value('Approved symbol', row_ids[0])
+                found[position], _ = index.lookup(symbol, 'Approved symbol')
+                logging.info(f"Matched {label} to {symbol} by local {column}")
+                break
+    return {position: record for position, record in found.items() if record is not None}
+
+PARALLEL_MIN_ROWS = 20000 # Inputs (or chunks) with fewer rows are resolved in-process even when n_jobs > 1
+_WORKER_INDEX = None # (index, local index) used by worker processes, inherited on fork or loaded by _init_worker
+
+def _init_worker(index_path): # Helper function to load the pickled indexes in worker processes that could not inherit them
+    global _WORKER_INDEX
+    if index_path:
+        with open(index_path, 'rb') as file:
+            _WORKER_INDEX = pickle.load(file)
+
+def _resolve_shard(task): # Helper function to resolve one shard of names offline in a worker, returning what the parent merges
+    names, report_ambiguities, fuzzy, fuzzy_distance = task
+    index, local = _WORKER_INDEX
+    stats, unresolved = RunStats(), {}
+    ambiguities = [] if report_ambiguities else None
+    result = resolve_gene_names(names, index, use_api=False, stats=stats, ambiguities=ambiguities, fuzzy=fuzzy, fuzzy_distance=fuzzy_distance,
+                                local=local, unresolved=unresolved)
+    return result, ambiguities, unresolved, stats.counters
+
+def _resolve_parallel(names, index, n_jobs, stats, ambiguities, use_api, api_workers, api_cache, fuzzy, fuzzy_distance,
+                      local, api_memo): # Helper function to resolve contiguous shards of rows in a process pool
+    # Workers run the whole offline pipeline (splitting, matching, ambiguity, local and fuzzy matching, folding) on their rows and
+    # hand back the labels they could not match. The parent sends those to the API once, then re-resolves only the rows an API
+    # answer changes, from the memo, so the output is identical to a serial run.
+    import numpy as np
+    import pandas as pd
+    global _WORKER_INDEX
+    if isinstance(index, GeneIndex):
+        index.frames() # Built once before the workers start, so forked workers share them
+    if fuzzy:
+        get_fuzzy_index(index)
+    bounds = np.linspace(0, len(names), n_jobs + 1).astype(int)
+    tasks = [(names.iloc[start:end].reset_index(drop=True), ambiguities is not None, fuzzy, fuzzy_distance) for start, end in zip(bounds[:-1], bounds[1:])]
 
+    index_path = None
+    if 'fork' in multiprocessing.get_all_start_methods(): # Forked workers share the parent's indexes copy-on-write
+        context = multiprocessing.get_context('fork')
+        _WORKER_INDEX = (index, local)
+    else:
+        context = multiprocessing.get_context('spawn')
+        fd, index_path = tempfile.mkstemp(suffix='.pkl')
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump((index, local), file, protocol=pickle.HIGHEST_PROTOCOL)
+    parts, waiting, reported = [], {}, set()
+    try:
+        with stats.timer("offline_match"), ProcessPoolExecutor(n_jobs, mp_context=context, initializer=_init_worker, initargs=(index_path,)) as executor:
+            for start, (result, found, unresolved, counters) in zip(bounds, executor.map(_resolve_shard, tasks)):
+                parts.append(result)
+                for name, amount in counters.items():
+                    if name != "rows":
+                        stats.count(name, amount)
+                stats.count("rows", len(result) - len({row for rows in unresolved.values() for row in rows}))
+                for label, rows in unresolved.items():
+                    waiting.setdefault(label, []).extend(start + row for row in rows)
+                if ambiguities is not None: # A label shared by several shards is reported once, as a serial run does
+                    ambiguities.extend(row for row in found if row[0] not in reported)
+                    reported.update(row[0] for row in found)
+    finally:
+        _WORKER_INDEX = None
+        if index_path:
+            os.remove(index_path)
+    result = pd.concat(parts, ignore_index=True)
+
+    answered = _row_progress([label for label, rows in waiting.items() for row in rows], [row for rows in waiting.values() for row in rows],
+                             len({row for rows in waiting.values() for row in rows}), stats)
+    if use_api and waiting:
+        api_memo = {} if api_memo is None else api_memo
+        answered([label for label in waiting if label in api_memo])
+        pending = [label for label in waiting if label not in api_memo]
+        with stats.timer("api_fallback"):
+            found = _resolve_with_api(pending, api_workers, api_cache, stats, answered) if pending else {}
+        api_memo.update((label, found.get(label)) for label in pending)
+        redo = sorted({row for label, rows in waiting.items() if api_memo[label] is not None for row in rows})
+        if redo:
+            with stats.timer("collapse"):
+                again = resolve_gene_names(names.iloc[redo], index, use_api=True, stats=RunStats(), fuzzy=fuzzy, fuzzy_distance=fuzzy_distance,
+                                           local=local, api_memo=api_memo)
+            result.iloc[redo] = again.to_numpy()
+    answered(list(waiting))
+    return result
+
+AMBIGUITY_COLUMNS = ['user_input', 'chosen_symbol', 'candidate_symbol', 'candidate_name', 'match_type']
+
+def _ambiguous_labels(labels, index): # Helper function to list every candidate of the labels that lead to more than one gene, as AMBIGUITY_COLUMNS rows
+    # Symbols are their own keys, so most labels are ruled out before classification
+    candidates = labels.isin(index.ambiguous)
+    if any(index.ambiguous_ids.values()):
+        candidates |= labels.str.match(r'ENSG|HGNC:|\d')
+    labels = labels[candidates]
+    keys, types = classify_labels(labels)
+    rows = []
+    for label, key, gene_type in zip(labels, keys, types):
+        gene_type = gene_type if isinstance(gene_type, str) else None
+        if key not in (index.ambiguous_ids.get(gene_type, ()) if gene_type else index.ambiguous):
+            continue # Precomputed at build time, so unambiguous labels cost one set lookup
+        found = index.candidates(key, gene_type)
+        if len(found) > 1:
+            rows.extend([label, found[0][0][0], record[0], record[1], column] for record, column in found)
+    return rows
+
+def _fuzzy_match(labels, index, max_distance): # Helper function to suggest near-miss symbols for unmatched labels, returning {position: suggestions}
+    return dict(zip(labels.index, get_fuzzy_index(index).suggest_many(labels.tolist(), max_distance)))
+
+def _format_suggestions(suggestions): # Helper function to render suggestions as "SYMBOL (match type, distance N)" items
+    return "; ".join(f"{record[0]} ({column}, distance {distance})" for record, column, distance in suggestions) or None
+
+def resolve_gene_names(names, index, use_api=True, api_workers=API_WORKERS, api_cache=None, n_jobs=1, stats=None,
+                       ambiguities=None, fuzzy=False, fuzzy_distance=FUZZY_MAX_DISTANCE, local=None, api_memo=None,
+                       unresolved=None): # Batch engine: returns the result columns and matching_status for each name, in input order
+    # If ambiguities is a list, a row is appended to it for every candidate of each label that several genes share.
+    # With fuzzy=True labels still unmatched offline get up to FUZZY_SUGGESTIONS near-miss symbols within fuzzy_distance edits in a
+    # suggestions column; a single suggestion at distance 0 (punctuation only, or an Excel date such as 1-Mar) is taken as the match.
+    # local is an index from load_local_index, tried for labels the snapshot misses before fuzzy matching and the API.
+    # api_memo, a dict kept across calls, holds the API answer (None for a miss) of every label already sent, so a run resolving
+    # its input in chunks still queries each distinct label once. With n_jobs > 1, inputs of PARALLEL_MIN_ROWS rows or more are resolved in
+    # contiguous shards of rows by a process pool (see _resolve_parallel). If unresolved is a dict, every distinct label still unmatched
+    # before the API fallback is mapped to the list of rows holding it.
+    import numpy as np
+    import pandas as pd
+    stats = stats or RunStats()
+    names = pd.Series(names, dtype=object).reset_index(drop=True).astype(str)
+    if n_jobs > 1 and len(names) >= PARALLEL_MIN_ROWS:
+        return _resolve_parallel(names, index, n_jobs, stats, ambiguities, use_api, api_workers, api_cache, fuzzy, fuzzy_distance, local, api_memo)
+    multi = names.str.contains(',', regex=False).to_numpy()
+    labels = names.str.split(',').explode().str.strip()
+    labels = labels[labels != '']
+    rows = labels.index.to_numpy()
+
+    # Each distinct label (including those split out of comma lists) is resolved once, then broadcast back
+    codes, distinct = pd.factorize(labels.to_numpy())
+    distinct = pd.Series(distinct, dtype=object)
+    values = _match_labels(distinct, index, stats)
+
+    unmatched = np.flatnonzero(~values['matched'].to_numpy())
+    stats.count("labels", len(labels))
+    stats.count("distinct_labels", len(distinct))
+    stats.count("offline_hits", len(distinct) - len(unmatched))
+    if ambiguities is not None: # Before the API fallback, which only fills labels with no candidate at all
+        with stats.timer("ambiguity"):
+            found = _ambiguous_labels(distinct.iloc[np.flatnonzero(values['matched'].to_numpy())], index)
+        stats.count("ambiguous_labels", len({row[0] for row in found}))
+        ambiguities.extend(found)
+    if local is not None and len(unmatched):
+        with stats.timer("local_match"):
+            found = _match_local(distinct.iloc[unmatched], local, index)
+        if found:
+            values.loc[list(found), RESULT_COLUMNS] = [list(record) for record in found.values()]
+            values.loc[list(found), 'matched'] = True
+        stats.count("local_hits", len(found))
+        unmatched = np.flatnonzero(~values['matched'].to_numpy())
+    if fuzzy:
+        values['suggestions'] = None
+        if len(unmatched):
+            with stats.timer("fuzzy"):
+                suggested = _fuzzy_match(distinct.iloc[unmatched], index, fuzzy_distance)
+            accepted = [position for position, found in suggested.items()
+                        if found and found[0][2] == 0 and (len(found) == 1 or found[1][2] > 0)]
+            for position in accepted:
+                logging.info(f"Matched {distinct.iat[position]} to {suggested[position][0][0][0]} by fuzzy {suggested[position][0][1]}")
+            if accepted:
+                values.loc[accepted, RESULT_COLUMNS] = [list(suggested[position][0][0]) for position in accepted]
+                values.loc[accepted, 'matched'] = True
+            for position, found in suggested.items():
+                values.at[position, 'suggestions'] = _format_suggestions(found)
+            stats.count("fuzzy_matches", len(accepted))
+            stats.count("fuzzy_suggested", sum(1 for found in suggested.values() if found))
+            unmatched = np.flatnonzero(~values['matched'].to_numpy())
+    # Rows are counted as they finish: those matched offline now, the others as the API answers their last label
+    waiting = np.isin(codes, unmatched)
+    waiting_labels, waiting_rows = distinct.to_numpy()[codes[waiting]].tolist(), rows[waiting].tolist()
+    if unresolved is not None:
+        for label, row in zip(waiting_labels, waiting_rows):
+            unresolved.setdefault(label, []).append(row)
+    answered = _row_progress(waiting_labels, waiting_rows, len(names), stats)
+    if use_api and len(unmatched):
+        pending = distinct.iloc[unmatched]
+        if api_memo is not None:
+            answered(pending[pending.isin(api_memo.keys())])
+            pending = pending[~pending.isin(api_memo.keys())]
+        with stats.timer("api_fallback"):
+            found = _resolve_with_api(pending, api_workers, api_cache, stats, answered) if len(pending) else {}
+        if api_memo is not None:
+            api_memo.update((label, found.get(label)) for label in pending)
+            found = {label: api_memo[label] for label in distinct.iloc[unmatched] if api_memo[label] is not None}
+        hits = [position for position in unmatched if distinct.iat[position] in found]
+        if hits:
+            values.loc[hits, RESULT_COLUMNS] = [found[distinct.iat[position]] for position in hits]
+            values.loc[hits, 'matched'] = True
+    answered(distinct.iloc[unmatched]) # Misses, and every label when the API is not used
+    values = values.take(codes).reset_index(drop=True)
+
+    with stats.timer("collapse"):
+        return _collapse_rows(values, rows, multi, len(names))
+
+CHECKPOINT_ROWS = 100000 # Input rows convert_gene_names resolves and journals together when a run is checkpointed
+JOURNAL_VERSION = 1
+
+class RunJournal: # Append-only JSON-lines journal of resolved blocks, so a run that dies part way resumes where it stopped
+    # The first line holds the run's settings; each further line is one block of rows keyed by its first row and a hash of
+    # its input labels, with the resolved columns and ambiguity rows of that block. A journal written under other settings
+    # (another snapshot file, block size or matching options) is discarded, as is a line cut short by a crash.
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = dict(settings, version=JOURNAL_VERSION)
+        self.blocks = {}
+        good = 0 # Bytes of the journal that can be kept
+        try:
+            with open(path, 'rb') as file:
+                header = file.readline()
+                if json.loads(header) == self.settings:
+                    good = len(header)
+                    for line in file:
+                        if not line.endswith(b"\n"): # The last line of a run killed mid-write
+                            break
+                        block = json.loads(line)
+                        self.blocks[block['start']] = block
+                        good += len(line)
+                else:
+                    logging.info(f"Ignoring {path}, which was written with other settings")
+        except (OSError, ValueError):
+            pass
+        if self.blocks:
+            logging.info(f"Resuming from {path}: {sum(block['stop'] - block['start'] for block in self.blocks.values())} rows already resolved")
+        self._file = open(path, 'r+b' if good else 'wb')
+        self._file.truncate(good)
+        self._file.seek(good)
+        if not good:
+            self._write(self.settings)
+
+    @staticmethod
+    def _hash(names):
+        return hashlib.sha1("\x1f".join(names).encode()).hexdigest()
+
+    def _write(self, data):
+        self._file.write(json.dumps(data).encode() + b"\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def get(self, start, names): # The (resolved, ambiguity rows) journaled for the block of names starting at row start, or None
+        import pandas as pd
+        block = self.blocks.get(start)
+        if block is None or block['stop'] != start + len(names) or block['hash'] != self._hash(names):
+            return None
+        return pd.DataFrame(block['values'], columns=block['columns'], dtype=object), block['ambiguities']
+
+    def record(self, start, names, resolved, ambiguities):
+        self._write({'start': start, 'stop': start + len(names), 'hash': self._hash(names), 'columns': list(resolved.columns),
+                     'values': resolved.to_numpy().tolist(), 'ambiguities': ambiguities})
+
+    def close(self, remove=True): # Closes the journal, deleting it once the run's output is complete
+        self._file.close()
+        if remove:
+            os.remove(self.path)
+
+def _journal_settings(path, name_col, use_api, fuzzy, fuzzy_distance, local_sources=None, block_rows=CHECKPOINT_ROWS): # Helper function to describe a run's journal
+    info = os.stat(path)
+    local = {name: [os.path.abspath(source), *_snapshot_signature(source)[1:]] for name, source in (local_sources or {}).items() if source}
+    return {'snapshot': [os.path.abspath(path), info.st_size, info.st_mtime_ns], 'block_rows': block_rows, 'name_col': name_col,
+            'use_api': use_api, 'fuzzy': fuzzy, 'fuzzy_distance': fuzzy_distance, 'local': local}
+
+def _annotate(df_original, name_col, index, api_workers, api_cache, n_jobs=1, stats=None, use_api=True,
+              ambiguities=None, fuzzy=False, fuzzy_distance=FUZZY_MAX_DISTANCE, journal=None, first_row=0, local=None,
+              api_memo=None): # Helper function to return a copy of df with the result columns filled in
+    # With a journal, the rows of df are resolved in one call and journaled as one block keyed by first_row, or read back from it
     df = df_original.copy()
     df['matching_status'] = "un-matched"
     df = _insert_result_columns(df, name_col)
+    options = dict(use_api=use_api, api_workers=api_workers, api_cache=api_cache, n_jobs=n_jobs, stats=stats, fuzzy=fuzzy, fuzzy_distance=fuzzy_distance,
+                   local=local, api_memo=api_memo)
+    if journal is None:
+        resolved = resolve_gene_names(df[name_col], index, ambiguities=ambiguities, **options)
+    else:
+        names = df[name_col].astype(str).tolist()
+        found = journal.get(first_row, names)
+        if found is None:
+            block_ambiguities = []
+            found = resolve_gene_names(names, index, ambiguities=block_ambiguities, **options), block_ambiguities
+            journal.record(first_row, names, *found)
+        elif stats:
+            stats.count("resumed_rows", len(names))
+        resolved = found[0]
+        if ambiguities is not None:
+            ambiguities.extend(found[1])
+    df[list(resolved.columns)] = resolved.to_numpy()
+    df.rename(columns={name_col: "user_input"}, inplace=True)
+    return df
 
-    for idx, row in df.iterrows():
-        name = row[name_col]
-        if ',' in str(name):
-            process_multiple_names(df, idx, name, path)
-        else:
-            process_row(df, idx, name, path)
+def _write_ambiguities(rows, path, append=False, reported=None): # Helper function to write ambiguity rows as CSV, skipping labels already in reported
+    if reported is not None:
+        rows = [row for row in rows if row[0] not in reported]
+        reported.update(row[0] for row in rows)
+    with open(path, 'a' if append else 'w', encoding='utf-8', newline='') as file:
+        writer = csv.writer(file)
+        if not append:
+            writer.writerow(AMBIGUITY_COLUMNS)
+        writer.writerows(rows)
+    logging.info(f"Wrote {len(rows)} ambiguous candidates to {path}")
 
-    os.remove(path)
-    df.rename(columns={name_col: "user_input"}, inplace=True)
-    output_path = os.path.join(os.getcwd(), "Outputs", f"{output_name}_results.csv")
-    df.to_csv(output_path, index=False)
+def convert_gene_names(df_original, name_col, to_return, output_name = 'results', offline = False, cache_dir = None,
+                       api_workers = API_WORKERS, api_cache = True, n_jobs = 1, return_stats = False,
+                       mmap_index = False, fuzzy = False, fuzzy_distance = FUZZY_MAX_DISTANCE, checkpoint = False,
+                       progress = None, progress_interval = PROGRESS_INTERVAL, local_sources = None):
+    # With return_stats=True the RunStats of the run is returned too, as (df, stats) or just stats when to_return is False.
+    # Labels shared by several genes are listed with all their candidates in Outputs/<output_name>_ambiguous.csv.
+    # fuzzy=True adds a suggestions column for labels not found offline (see resolve_gene_names)
+    # With checkpoint=True rows are resolved CHECKPOINT_ROWS per job at a time and journaled to Outputs/<output_name>.journal; running the same
+    # conversion again after a crash resolves only the chunks that were not journaled. The journal is removed once the output is written.
+    # progress is a callback given a RunStats.progress() dict every progress_interval seconds, or True for a ConsoleProgress on stderr
+    # local_sources maps LOCAL_SOURCES names (gene_info, gene_history, ensembl_xrefs, ensembl_history) to local files resolving snapshot misses offline
+    setup_logging(output_name)
+    stats = RunStats(ConsoleProgress() if progress is True else progress, progress_interval)
+    stats.total_rows = len(df_original)
+    with stats.reporting(), stats.timer("total"):
+        columns_needed = addColumns(df_original, name_col)
+        with stats.timer("download"):
+            path = makeAndFetchURL(columns_needed, cache_dir=cache_dir, offline=offline, stats=stats)
+        with stats.timer("index_build"):
+            index = load_mapped_index(path) if mmap_index else load_index(path, persist=True)
 
+        local = None
+        if local_sources:
+            with stats.timer("local_index"):
+                local = load_local_index(index, path, local_sources, cache_dir)
+        cache = get_api_cache(cache_dir) if api_cache else None
+        block_rows = CHECKPOINT_ROWS * max(n_jobs, 1) # Each worker still gets a CHECKPOINT_ROWS shard of a chunk
+        journal = RunJournal(os.path.join(os.getcwd(), "Outputs", f"{output_name}.journal"),
+                             _journal_settings(path, name_col, True, fuzzy, fuzzy_distance, local_sources, block_rows)) if checkpoint else None
+        ambiguities = []
+        if journal is None:
+            df = _annotate(df_original, name_col, index, api_workers, cache, n_jobs, stats, ambiguities=ambiguities, fuzzy=fuzzy,
+                           fuzzy_distance=fuzzy_distance, local=local)
+        else:
+            import pandas as pd
+            api_memo = {}
+            df = pd.concat([_annotate(df_original.iloc[start:start + block_rows], name_col, index, api_workers, cache, n_jobs, stats,
+                                      ambiguities=ambiguities, fuzzy=fuzzy, fuzzy_distance=fuzzy_distance, journal=journal, first_row=start,
+                                      local=local, api_memo=api_memo)
+                            for start in range(0, max(len(df_original), 1), block_rows)])
+        with stats.timer("output"):
+            output_path = os.path.join(os.getcwd(), "Outputs", f"{output_name}_results.csv")
+            df.to_csv(output_path, index=False)
+            _write_ambiguities(ambiguities, os.path.join(os.getcwd(), "Outputs", f"{output_name}_ambiguous.csv"), reported=set())
+        if journal:
+            journal.close()
+    stats.log_summary()
+
+    if to_return and return_stats:
+        return df, stats
+    if return_stats:
+        return stats
     if to_return:
-        return df
\ No newline at end of file
+        return df
+
+ALL_COLUMNS = ["app_sym", "app_name", "prev_sym", "aliases", "hgnc_id", "pub_ensembl_id", "pub_eg_id"]
+
+def _table_separator(path): # Helper function to pick the delimiter from a file name, ignoring a .gz suffix
+    name = path[:-3] if path.endswith('.gz') else path
+    return '\t' if name.endswith(('.tsv', '.txt')) else ','
+
+def _count_lines(path): # Helper function to count the lines of a file, reading it in large blocks
+    with open(path, 'rb') as file:
+        return sum(block.count(b"\n") for block in iter(partial(file.read, 1 << 20), b""))
+
+def convert_gene_file(input_path, output_path, name_col, chunksize = 50000, output_name = None, offline = False,
+                      cache_dir = None, api_workers = API_WORKERS, api_cache = True, n_jobs = 1, return_stats = False,
+                      mmap_index = False, use_api = True, sep = None, ambiguity_report = None, fuzzy = False,
+                      fuzzy_distance = FUZZY_MAX_DISTANCE, checkpoint = False, progress = None,
+                      progress_interval = PROGRESS_INTERVAL, local_sources = None, input_sep = None):
+    import pandas as pd
+    # Streams input_path to output_path one chunk at a time, so memory stays flat however large the input is.
+    # CSV or TSV is picked from each file name unless sep (output) or input_sep (input) is given, and a .gz suffix reads/writes
+    # gzip. Either may also be an open text stream such as sys.stdin/sys.stdout, which is CSV unless a separator is given, and left open.
+    # Labels shared by several genes are listed in ambiguity_report (CSV), by default <output name>_ambiguous.csv beside a regular output file.
+    # With checkpoint=True each resolved chunk is journaled to <output_path>.journal; after a crash the same command rewrites the
+    # output but resolves only the chunks that were not journaled. Not available when reading stdin or writing to stdout.
+    # progress works as in convert_gene_names; the ETA counts the lines of an uncompressed input file, so it is an estimate.
+    # local_sources works as in convert_gene_names.
+    reading_file, writing_file = isinstance(input_path, str), isinstance(output_path, str)
+    setup_logging(output_name or (os.path.basename(input_path).split('.')[0] if reading_file else "stdin"))
+    stats = RunStats(ConsoleProgress() if progress is True else progress, progress_interval)
+    if stats.progress_callback and reading_file and not input_path.endswith('.gz'):
+        stats.total_rows = max(_count_lines(input_path) - 1, 0)
+    with stats.reporting(), stats.timer("total"):
+        with stats.timer("download"): # Column types are unknown before reading, so request every ID
+            path = makeAndFetchURL(ALL_COLUMNS, cache_dir=cache_dir, offline=offline, stats=stats)
+        with stats.timer("index_build"):
+            index = load_mapped_index(path) if mmap_index else load_index(path, persist=True)
+        local = None
+        if local_sources:
+            with stats.timer("local_index"):
+                local = load_local_index(index, path, local_sources, cache_dir)
+        cache = get_api_cache(cache_dir) if api_cache else None
+
+        reader = pd.read_csv(input_path, sep=input_sep or _table_separator(input_path if reading_file else ''), chunksize=chunksize, dtype=str, keep_default_na=False)
+        sep = sep or _table_separator(output_path if writing_file else '')
+        if ambiguity_report is None and writing_file:
+            ambiguity_report = re.sub(r'(\.(csv|tsv|txt))?(\.gz)?$', '', output_path) + "_ambiguous.csv"
+        reported = set()
+        journal = None
+        if checkpoint and reading_file and writing_file:
+            journal = RunJournal(f"{output_path}.journal", _journal_settings(path, name_col, use_api, fuzzy, fuzzy_distance, local_sources, chunksize))
+        target = output_path if writing_file else getattr(output_path, 'name', "output stream")
+        if writing_file:
+            opener = gzip.open if output_path.endswith('.gz') else open
+            output_file = opener(output_path, 'wt', encoding='utf-8', newline='')
+        else: # Written in place, so a stream redirected with >> keeps what it held
+            output_file = nullcontext(output_path)
+        rows = 0
+        api_memo = {} # Chunks share API answers, so a label missing from the snapshot is queried once per run
+        with output_file as output:
+            for number, chunk in enumerate(reader):
+                ambiguities = [] if ambiguity_report else None
+                df = _annotate(chunk, name_col, index, api_workers, cache, n_jobs, stats, use_api, ambiguities, fuzzy, fuzzy_distance, journal, rows, local, api_memo)
+                with stats.timer("output"):
+                    df.to_csv(output, sep=sep, index=False, header=number == 0)
+                    output.flush()
+                    if ambiguity_report:
+                        _write_ambiguities(ambiguities, ambiguity_report, append=number > 0, reported=reported)
+                rows += len(df)
+                logging.info(f"Wrote {rows} rows to {target}")
+        if journal:
+            journal.close()
+    stats.log_summary()
+    return (output_path, stats) if return_stats else output_path
+
+STREAM_BATCH = 1000 # Lines stream_gene_names reads, resolves and flushes together
+STREAM_MEMO = 100000 # Distinct labels remembered across batches before the memo is cleared
+
+def _stream_resolve(labels, index, memo, use_api, api_workers, api_cache, stats): # Helper function to fill memo with (values, matched) for a batch's labels
+    new = [label for label in dict.fromkeys(labels) if label not in memo]
+    misses = []
+    with stats.timer("offline_match"):
+        for label in new:
+            key, gene_type = transform_string(label)
+            record, _ = index.lookup(key, gene_type)
+            if record is None:
+                record = _lookup_normalized(index, label, stats)[0]
+            memo[label] = (record or (None,) * len(RESULT_COLUMNS), record is not None)
+            if record is None:
+                misses.append(label)
+    stats.count("distinct_labels", len(new))
+    stats.count("offline_hits", len(new) - len(misses))
+    if use_api and misses:
+        with stats.timer("api_fallback"):
+            found = _resolve_with_api(misses, api_workers, api_cache, stats)
+        memo.update((label, (values, True)) for label, values in found.items())
+
+def _stream_row(name, memo): # Helper function to build the result columns of one name, folding comma lists as _collapse_rows does
+    labels = [label.strip() for label in name.split(',') if label.strip()]
+    if ',' not in name:
+        values, matched = memo[labels[0]] if labels else ((None,) * len(RESULT_COLUMNS), False)
+        return [value or "" for value in values] + ["matched" if matched else "un-matched"]
+    results = [memo[label] for label in labels]
+    joined = ["; ".join(sorted({values[i] for values, _ in results if values[i] is not None})) for i in range(len(RESULT_COLUMNS))]
+    return joined + ["matched" if any(matched for _, matched in results) else "un-matched"]
+
+def stream_gene_names(input, output, name_col=None, sep="\t", offline=False, cache_dir=None, use_api=True,
+                      api_workers=API_WORKERS, api_cache=True, batch_size=STREAM_BATCH, mmap_index=False,
+                      return_stats=False):
+    # Reads gene labels from the text stream input and writes enriched lines to output, batch_size lines at a time, flushing after each batch.
+    # Without name_col every line is one name (or comma list) and output lines are the name and the result columns, with no header.
+    # With name_col input is a sep-delimited table with a header, and the result columns are appended to each row.
+    setup_logging("stream")
+    stats = RunStats()
+    with stats.timer("total"):
+        with stats.timer("download"):
+            path = makeAndFetchURL(ALL_COLUMNS, cache_dir=cache_dir, offline=offline, stats=stats)
+        with stats.timer("index_build"):
+            index = load_mapped_index(path) if mmap_index else load_index(path, persist=True)
+        cache = get_api_cache(cache_dir) if api_cache and use_api else None
+
+        writer = csv.writer(output, delimiter=sep, lineterminator="\n")
+        if name_col is None:
+            rows = ([line.rstrip("\r\n")] for line in input)
+            position = 0
+        else:
+            rows = csv.reader(input, delimiter=sep)
+            header = next(rows, None)
+            if header is None:
+                return stats if return_stats else None
+            if name_col not in header:
+                raise KeyError(f"Column {name_col!r} not found in the input header")
+            position = header.index(name_col)
+            writer.writerow(header + RESULT_COLUMNS + ['matching_status'])
+        memo, formatted = {}, {} # label -> (values, matched) and name -> output cells, shared by later batches
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            names = [row[position] if position < len(row) else "" for row in batch]
+            new = [name for name in dict.fromkeys(names) if name not in formatted]
+            if len(formatted) + len(new) > STREAM_MEMO: # Bounded memory: forget earlier labels rather than grow without limit
+                memo.clear()
+                formatted.clear()
+                new = list(dict.fromkeys(names))
+            labels = [label.strip() for name in new for label in name.split(',') if label.strip()]
+            _stream_resolve(labels, index, memo, use_api, api_workers, cache, stats)
+            formatted.update((name, _stream_row(name, memo)) for name in new)
+            with stats.timer("output"):
+                writer.writerows([*row, *formatted[name]] for row, name in zip(batch, names))
+                output.flush()
+            stats.count("rows", len(batch))
+    stats.log_summary()
+    return stats if return_stats else None
+
+CHANGE_COLUMNS = ['changed_at', 'hgnc_id', 'symbol', 'change', 'column', 'old_value', 'new_value']
+
+def _change_log_path(columns, cache_dir=None): # Helper function to get the change log kept next to a cached snapshot
+    return f"{os.path.splitext(_snapshot_paths(columns, _cache_dir(cache_dir))[0])[0]}_changes.csv"
+
+def refresh_snapshot(columns=ALL_COLUMNS, cache_dir=None, offline=False, stats=None): # Revalidates a snapshot now and patches its saved index, returning (index, changes)
+    # changes lists what differs by HGNC ID (added, withdrawn, renamed, or another column updated) and is appended to
+    # the snapshot's change log. A first download, or a snapshot that cannot be patched in, is indexed from scratch.
+    data_path = _snapshot_paths(columns, _cache_dir(cache_dir))[0]
+    index = load_index(data_path, persist=True) if os.path.exists(data_path) else None
+    previous = _snapshot_signature(data_path) if index is not None else None
+    path = makeAndFetchURL(columns, cache_dir=cache_dir, ttl=0, offline=offline, stats=stats)
+    if index is None or _snapshot_signature(path) == previous:
+        return load_index(path, persist=True), []
+
+    start = time.perf_counter()
+    try:
+        changes, updates, order = index.diff(path)
+    except ValueError as e:
+        logging.warning(f"Rebuilding the index of {path} instead of patching it: {e}")
+        return load_index(path, persist=True), []
+    index.patch(updates, order)
+    index.save(f"{os.path.splitext(path)[0]}.idx", path)
+    _INDEX_CACHE.clear()
+    _INDEX_CACHE[(os.path.abspath(path), os.path.getmtime(path))] = index
+    if os.path.exists(f"{os.path.splitext(path)[0]}.gnmx"):
+        write_mapped_index(index, f"{os.path.splitext(path)[0]}.gnmx", path)
+    logging.info(f"Patched the index of {path} with {len(updates)} changed genes in {time.perf_counter() - start:.2f}s")
+
+    # A withdrawn symbol that another gene now lists as previous was merged or renamed into it
+    for change in changes:
+        if change['change'] == 'withdrawn':
+            record, column = index.lookup(change['old_value'], 'Previous symbols')
+            change['new_value'] = record[0] if record else ''
+    changed_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+    log_path = _change_log_path(columns, cache_dir)
+    new_log = not os.path.exists(log_path)
+    with open(log_path, 'a', encoding='utf-8', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=CHANGE_COLUMNS)
+        if new_log:
+            writer.writeheader()
+        writer.writerows({'changed_at': changed_at, **change} for change in changes)
+    if stats:
+        for change in changes:
+            stats.count(f"snapshot_changes:{change['change']}")
+    return index, changes
+
+def read_change_log(columns=ALL_COLUMNS, cache_dir=None, since=None): # Change log rows of a snapshot, optionally only those recorded after since (epoch seconds)
+    log_path = _change_log_path(columns, cache_dir)
+    if not os.path.exists(log_path):
+        return []
+    with open(log_path, encoding='utf-8', newline='') as file:
+        changes = list(csv.DictReader(file))
+    if since is not None:
+        changes = [change for change in changes if time.mktime(time.strptime(change['changed_at'], '%Y-%m-%dT%H:%M:%S')) >= since]
+    return changes
+
+def changed_results(results_path, columns=ALL_COLUMNS, cache_dir=None, symbol_col='Approved symbol'): # Rows of an earlier output whose gene changed since, one per change
+    changes = {}
+    for change in read_change_log(columns, cache_dir, since=int(os.path.getmtime(results_path))):
+        changes.setdefault(change['symbol'], []).append(change)
+    with open(results_path, encoding='utf-8', newline='') as file:
+        reader = csv.DictReader(file, delimiter=_table_separator(results_path))
+        first = reader.fieldnames[0]
+        return [{'user_input': row[first], **change} for row in reader
+                for symbol in _split_cell(row.get(symbol_col)) if ',' not in symbol for change in changes.get(symbol, [])]
+
+FORMATS = {"csv": ",", "tsv": "\t"}
+
+def lookup_labels(labels, offline=False, cache_dir=None, api_cache=True): # Small lookups without pandas: mapped index first, then the REST API for misses
+    index = load_mapped_index(makeAndFetchURL(ALL_COLUMNS, cache_dir=cache_dir, offline=offline))
+    cache = get_api_cache(cache_dir) if api_cache and not offline else None
+    results = {}
+    for label in dict.fromkeys(label.strip() for label in labels):
+        record, column = index.lookup(*transform_string(label))
+        if record is None:
+            record, column, rules = _lookup_normalized(index, label)
+            column = f"{column} ({', '.join(rules)})" if rules else column
+        if record is not None:
+            results[label] = list(record) + [column]
+    misses = [label for label in dict.fromkeys(label.strip() for label in labels) if label not in results]
+    if misses and not offline:
+        for label, values in _resolve_with_api(misses, cache=cache).items():
+            results[label] = values + ["api"]
+    return [[label] + [value or "" for value in results.get(label.strip(), [None] * len(RESULT_COLUMNS) + ["un-matched"])] for label in labels]
+
+def main(argv=None): # Entry point of the gene-convert command; returns the process exit status
+    import argparse
+    parser = argparse.ArgumentParser(prog="gene-convert", description="Map gene symbols and IDs to current HGNC approved symbols.")
+    parser.add_argument("--cache-dir", default=None, help="snapshot and API cache directory (default: $GENE_LOOKUP_CACHE or ./Cache)")
+    common = argparse.ArgumentParser(add_help=False) # Lets --cache-dir also follow the command, without resetting one given before it
+    common.add_argument("--cache-dir", default=argparse.SUPPRESS, help="snapshot and API cache directory (default: $GENE_LOOKUP_CACHE or ./Cache)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="annotate a CSV/TSV file, streaming it chunk by chunk", parents=[common])
+    convert.add_argument("input", help="input table, or - for stdin")
+    convert.add_argument("-o", "--output", required=True, help="output table, or - for stdout; a .gz suffix writes gzip")
+    convert.add_argument("-c", "--column", required=True, help="column holding the gene labels")
+    convert.add_argument("-f", "--format", choices=FORMATS, help="output format (default: from the output file name)")
+    convert.add_argument("--input-format", choices=FORMATS, help="input format (default: from the input file name; for stdin, -f or csv)")
+    convert.add_argument("--offline", action="store_true", help="use only the cached snapshot, never the network")
+    convert.add_argument("--no-api", action="store_true", help="download the snapshot if needed but skip the REST fallback")
+    convert.add_argument("--chunksize", type=int, default=50000)
+    convert.add_argument("-j", "--jobs", type=int, default=1, help="worker processes for offline matching")
+    convert.add_argument("--mmap", action="store_true", help="use the memory-mapped index")
+    convert.add_argument("--fuzzy", action="store_true", help="suggest near-miss symbols for labels not found offline, in a suggestions column")
+    convert.add_argument("--fuzzy-distance", type=int, default=FUZZY_MAX_DISTANCE, help="largest edit distance a suggestion may have")
+    for source in LOCAL_SOURCES:
+        convert.add_argument(f"--{source.replace('_', '-')}", metavar="PATH", help=f"local {source} file (gzip allowed) for resolving snapshot misses offline")
+    convert.add_argument("--progress", action="store_true", help="print rows done, throughput, API queue and ETA to stderr while converting")
+    convert.add_argument("--progress-interval", type=float, default=PROGRESS_INTERVAL, help="seconds between progress reports")
+    convert.add_argument("--checkpoint", action="store_true", help="journal each resolved chunk to <output>.journal, so rerunning after a crash resumes")
+    convert.add_argument("--ambiguity-report", help="CSV listing every candidate of labels shared by several genes (default: <output>_ambiguous.csv)")
+
+    lookup = commands.add_parser("lookup", help="resolve labels given on the command line and print a TSV", parents=[common])
+    lookup.add_argument("labels", nargs="+")
+    lookup.add_argument("--offline", action="store_true", help="use only the cached snapshot, never the network")
+
+    stream = commands.add_parser("stream", help="read labels from stdin and write enriched lines to stdout as they are resolved", parents=[common])
+    stream.add_argument("-c", "--column", help="read a table with a header and resolve this column (default: one label per line)")
+    stream.add_argument("-f", "--format", choices=FORMATS, default="tsv", help="delimiter of the input table and of the output (default: tsv)")
+    stream.add_argument("--offline", action="store_true", help="use only the cached snapshot, never the network")
+    stream.add_argument("--no-api", action="store_true", help="download the snapshot if needed but skip the REST fallback")
+    stream.add_argument("--batch-size", type=int, default=STREAM_BATCH, help="lines resolved and flushed together; 1 answers each line at once")
+    stream.add_argument("--mmap", action="store_true", help="use the memory-mapped index")
+
+    commands.add_parser("serve", help="run the HTTP lookup service; other options go to gene_lookup_server.py", parents=[common], add_help=False)
+
+    refresh = commands.add_parser("refresh", help="check genenames.org for a new release now and patch the cached index with what changed", parents=[common])
+    refresh.add_argument("--check", metavar="RESULTS", help="instead, list rows of an earlier output whose gene changed after it was written")
+
+    commands.add_parser("cache-stats", help="print REST response cache statistics", parents=[common])
+    purge = commands.add_parser("cache-purge", help="drop expired REST responses from the cache", parents=[common])
+    purge.add_argument("--all", action="store_true", help="delete every entry instead of only expired ones")
+    args, options = parser.parse_known_args(argv) # Unknown options are only allowed for serve, which passes them on
+    if options and args.command != "serve":
+        parser.error(f"unrecognized arguments: {' '.join(options)}")
+
+    try:
+        if args.command == "convert":
+            for name, stream in (("input", sys.stdin), ("output", sys.stdout)):
+                if getattr(args, name) == "-" and hasattr(stream, "reconfigure"): # The CSV reader and writer handle line endings themselves
+                    stream.reconfigure(encoding='utf-8', newline='')
+            sep = FORMATS[args.format] if args.format else None
+            input_format = args.input_format or (args.format if args.input == "-" else None)
+            convert_gene_file(sys.stdin if args.input == "-" else args.input, sys.stdout if args.output == "-" else args.output, args.column,
+                              chunksize=args.chunksize, offline=args.offline, cache_dir=args.cache_dir,
+                              use_api=not (args.offline or args.no_api), n_jobs=args.jobs, mmap_index=args.mmap, sep=sep,
+                              ambiguity_report=args.ambiguity_report, fuzzy=args.fuzzy, fuzzy_distance=args.fuzzy_distance,
+                              checkpoint=args.checkpoint, progress=args.progress or None, progress_interval=args.progress_interval,
+                              local_sources={source: getattr(args, source) for source in LOCAL_SOURCES if getattr(args, source)},
+                              input_sep=FORMATS[input_format] if input_format else None)
+        elif args.command == "stream":
+            stream_gene_names(sys.stdin, sys.stdout, args.column, sep=FORMATS[args.format], offline=args.offline, cache_dir=args.cache_dir,
+                              use_api=not (args.offline or args.no_api), batch_size=args.batch_size, mmap_index=args.mmap)
+        elif args.command == "serve":
+            import gene_lookup_server
+            return gene_lookup_server.main((["--cache-dir", args.cache_dir] if args.cache_dir else []) + options)
+        elif args.command == "lookup":
+            results = lookup_labels(args.labels, offline=args.offline, cache_dir=args.cache_dir)
+            writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+            writer.writerow(["user_input"] + RESULT_COLUMNS + ["matched_by"])
+            writer.writerows(results)
+        elif args.command == "refresh":
+            writer = csv.writer(sys.stdout, delimiter="\t", lineterminator="\n")
+            if args.check:
+                rows = changed_results(args.check, cache_dir=args.cache_dir)
+                writer.writerow(["user_input"] + CHANGE_COLUMNS)
+                writer.writerows([row["user_input"]] + [row[column] for column in CHANGE_COLUMNS] for row in rows)
+            else:
+                index, changes = refresh_snapshot(cache_dir=args.cache_dir)
+                counts = {}
+                for change in changes:
+                    counts[change["change"]] = counts.get(change["change"], 0) + 1
+                genes = sum(1 for row_id in range(index.size) if index.value('HGNC ID', row_id)) # Withdrawn genes stay as empty rows
+                print(f"{genes} genes; " + (", ".join(f"{count} {change}" for change, count in sorted(counts.items())) or "no changes"))
+                if changes:
+                    print(f"Change log: {_change_log_path(ALL_COLUMNS, args.cache_dir)}")
+        else:
+            cache = get_api_cache(args.cache_dir)
+            if args.command == "cache-purge":
+                print(f"Removed {cache.purge(expired_only=not args.all)} cached responses")
+            print(json.dumps(cache.stats(), indent=1))
+    except BrokenPipeError: # The reader went away (e.g. `| head`); stop quietly like other pipeline tools
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 0
+    except (OSError, KeyError, ValueError) as e:
+        print(f"gene-convert: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())